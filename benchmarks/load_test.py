@@ -0,0 +1,167 @@
+"""End to end crawl load test against the local mock job board
+
+Starts benchmarks.mock_board in the background, points WorkuaParser / RabotaUa at it with the response cache
+turned off and reports resumes/sec, p50/p99 page latency as seen by the crawler, failed pages and peak RSS
+
+>> python -m benchmarks.load_test --site work_ua --mode async --resumes 2000 --latency 0.1 --error-rate 0.02
+>> python -m benchmarks.load_test --site rabota_ua --rate-limit 50 --output load.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+
+import parsers
+from parsers import AsyncRequestsManager, ParserPool, RabotaUa, RequestsManager, WorkuaParser
+from benchmarks.mock_board import MOCK_API_PATTERNS, BoardConfig, MockBoardServer
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+QUERY = {"position": ["python", "developer"]}
+
+
+class PageTimings:
+    """Wraps both request managers to record the latency of every page request, retries included"""
+
+    def __init__(self):
+        self.latencies = []
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def record(self, started, page_text):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started)
+            if page_text is None:
+                self.failed += 1
+
+    def __enter__(self):
+        make_request = RequestsManager.make_request
+        make_request_async = AsyncRequestsManager.make_request
+        self.originals = {"sync": make_request, "async": make_request_async}
+
+        @functools.wraps(make_request)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            page_text = make_request(*args, **kwargs)
+            self.record(started, page_text)
+            return page_text
+
+        @functools.wraps(make_request_async)
+        async def timed_async(*args, **kwargs):
+            started = time.perf_counter()
+            page_text = await make_request_async(*args, **kwargs)
+            self.record(started, page_text)
+            return page_text
+
+        RequestsManager.make_request = staticmethod(timed)
+        AsyncRequestsManager.make_request = timed_async
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        RequestsManager.make_request = staticmethod(self.originals["sync"])
+        AsyncRequestsManager.make_request = self.originals["async"]
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[q - 1]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished children (parser processes), None on Windows"""
+    if resource is None:
+        return None
+    kb_per_unit = 1 / 1024 if sys.platform == "darwin" else 1
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * kb_per_unit / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * kb_per_unit / 1024,
+    }
+
+
+def crawl(site, mode, site_url, concurrency=None, extraction_mode="dom"):
+    if site == "rabota_ua":
+        parser = RabotaUa(site_url=site_url + "/rabota_ua", extraction_mode=extraction_mode,
+                          api_url_patterns=MOCK_API_PATTERNS)
+        return sum(1 for _ in parser.run_script(QUERY))
+    parser = WorkuaParser(site_url=site_url + "/work_ua")
+    if mode == "sync":
+        return sum(1 for _ in parser.run_script(QUERY))
+
+    async def consume():
+        return sum([1 async for _ in parser.run_script_async(QUERY, concurrency=concurrency)])
+    return asyncio.run(consume())
+
+
+def run(config, site, mode, concurrency=None, extraction_mode="dom"):
+    RequestsManager.cache = None
+    with MockBoardServer(config) as server, PageTimings() as timings:
+        started = time.perf_counter()
+        resumes = crawl(site, mode, server.url, concurrency, extraction_mode)
+        elapsed = time.perf_counter() - started
+        statuses = dict(server.board.statuses)
+    ParserPool.shutdown()
+
+    return {
+        "site": site,
+        "mode": mode if site == "work_ua" else extraction_mode,
+        "resumes_served": config.resumes,
+        "resumes": resumes,
+        "seconds": elapsed,
+        "resumes_per_sec": resumes / elapsed if elapsed else None,
+        "pages": len(timings.latencies),
+        "failed_pages": timings.failed,
+        "page_latency_p50_ms": timings.percentile(50) * 1000 if timings.latencies else None,
+        "page_latency_p99_ms": timings.percentile(99) * 1000 if timings.latencies else None,
+        "server_statuses": {str(k): v for k, v in statuses.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "settings": {
+            "latency": config.latency, "jitter": config.jitter, "error_rate": config.error_rate,
+            "rate_limit": config.rate_limit, "pool_size": RequestsManager.pool_size,
+            "max_workers": parsers.BoundedExecutor.max_workers, "max_per_host": parsers.BoundedExecutor.max_per_host,
+            "async_concurrency": concurrency or AsyncRequestsManager.concurrency,
+            "parser_workers": ParserPool.max_workers, "html_backend": ParserPool.backend,
+        },
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--site", choices=("work_ua", "rabota_ua"), default="work_ua")
+    arg_parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="work_ua crawl flavour")
+    arg_parser.add_argument("--extraction-mode", choices=RabotaUa.extraction_modes, default="dom",
+                            help="rabota_ua candidate extraction, network renders every candidate in the browser")
+    arg_parser.add_argument("--resumes", type=int, default=500)
+    arg_parser.add_argument("--latency", type=float, default=0.05)
+    arg_parser.add_argument("--jitter", type=float, default=0.02)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--rate-limit", type=int, default=0)
+    arg_parser.add_argument("--concurrency", type=int, help="requests in flight of the async crawl")
+    arg_parser.add_argument("--backend", choices=tuple(parsers.HTML_BACKENDS), default=ParserPool.backend)
+    arg_parser.add_argument("--output", help="file to write json report to")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    ParserPool.backend = args.backend
+    config = BoardConfig(args.resumes, args.latency, args.jitter, args.error_rate, args.rate_limit)
+    report = run(config, args.site, args.mode, args.concurrency, args.extraction_mode)
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Local stand-in for work.ua and robota.ua to load test crawls without touching the real sites
+
+Serves listing pages with pagination and resume pages in both sites' markup, every response is delayed by
+latency +- jitter, a share of responses fail with 500 and requests above rate_limit per second get 429.
+robota.ua listing pages past the last one are answered with 404, so the crawl ends without a browser.
+robota.ua candidate pages load their resume as JSON from /rabota_ua/api/resumes/<id> the way the SPA loads it
+from its api, which RabotaUa(extraction_mode="network", api_url_patterns=MOCK_API_PATTERNS) captures.
+
+>> python -m benchmarks.mock_board --port 8080 --resumes 2000 --latency 0.05 --error-rate 0.01
+WorkuaParser(site_url="http://127.0.0.1:8080/work_ua"), RabotaUa(site_url="http://127.0.0.1:8080/rabota_ua")
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+WORK_UA_PER_PAGE = 14
+RABOTA_UA_PER_PAGE = 20
+MOCK_API_PATTERNS = ("/rabota_ua/api/",)
+
+FIRST_NAMES = ("Олена", "Іван", "Марія", "Тарас", "Андрій", "Оксана", "Дмитро", "Наталія")
+LAST_NAMES = ("Петренко", "Коваль", "Бондаренко", "Гнатюк", "Шевченко", "Мельник", "Кравченко")
+POSITIONS = ("Python developer", "Backend developer", "Data engineer", "QA engineer", "DevOps engineer")
+SKILLS = ("Python", "Django", "FastAPI", "PostgreSQL", "Redis", "Docker", "Kubernetes", "Kafka", "AWS", "Linux")
+CITIES = ("Київ", "Львів", "Одеса", "Дніпро", "Харків")
+
+
+class BoardConfig:
+    def __init__(self, resumes=500, latency=0.05, jitter=0.02, error_rate=0.0, rate_limit=0, file_resume_share=0.25,
+                 seed=0):
+        self.resumes = resumes
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # requests per second served before answering 429, 0 disables throttling
+        self.rate_limit = rate_limit
+        self.file_resume_share = file_resume_share
+        self.seed = seed
+
+
+def person(resume_id, seed):
+    rnd = random.Random(seed * 1000003 + resume_id)
+    return {
+        "name": f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}",
+        "position": rnd.choice(POSITIONS),
+        "city": rnd.choice(CITIES),
+        "age": rnd.randint(19, 60),
+        "salary": rnd.randrange(15000, 120000, 5000),
+        "jobs": [(rnd.choice(POSITIONS), f"Компанія {rnd.randint(1, 500)}", 2010 + i * 2) for i in range(rnd.randint(0, 5))],
+        "education": [f"Університет {rnd.randint(1, 50)}" for _ in range(rnd.randint(0, 2))],
+        "skills": rnd.sample(SKILLS, rnd.randint(1, 6)),
+        "languages": rnd.sample(("Англійська", "Українська", "Польська", "Німецька"), rnd.randint(1, 3)),
+        "file": rnd.random(),
+    }
+
+
+def work_ua_listing(config, page):
+    first = (page - 1) * WORK_UA_PER_PAGE
+    ids = range(first, min(first + WORK_UA_PER_PAGE, config.resumes))
+    cards = "\n".join(
+        f'<div class="card card-hover card-search resume-link card-visited wordwrap">'
+        f'<h2 class="mt-0"><a href="/resumes/{1000000 + i}/">{person(i, config.seed)["position"]}</a></h2>'
+        f'<p>{person(i, config.seed)["city"]}</p></div>'
+        for i in ids
+    )
+    pages = max(1, -(-config.resumes // WORK_UA_PER_PAGE))
+    nav = "".join(f'<li><span title="Стор. {p} з {pages}">{p}</span></li>' for p in sorted({1, page, pages}))
+    return (f'<!DOCTYPE html><html lang="uk"><head><title>Резюме</title></head><body>'
+            f'<div id="pjax-resume-list">{cards}</div><nav><ul class="pagination">{nav}</ul></nav></body></html>')
+
+
+def work_ua_resume(config, resume_id):
+    p = person(resume_id - 1000000, config.seed)
+    if p["file"] < config.file_resume_share:
+        experience = "".join(f"<p>{title}, {company}, {year} — {year + 2}</p>" for title, company, year in p["jobs"])
+        return (f'<!DOCTYPE html><html><body><h2 class="mb-0">Завантажений файл</h2>'
+                f'<div class="wordwrap" id="add_info"><p>{p["name"]}</p><p>Про себе</p><p>{p["position"]}, {p["city"]}</p>'
+                f'<p>Досвід роботи</p>{experience}<p>Освіта</p>{"".join(f"<p>{e}</p>" for e in p["education"])}'
+                f'<p>Навички: {", ".join(p["skills"])}</p><p>Знання мов</p><p>{", ".join(p["languages"])}</p>'
+                f'</div></body></html>')
+
+    jobs = "".join(f"<h2>{title}</h2><p>{company}, з {year} по {year + 2}</p><p>Розробка та підтримка сервісів</p>"
+                   for title, company, year in p["jobs"])
+    education = "".join(f"<h2>{e}</h2><p>Комп'ютерні науки</p>" for e in p["education"])
+    skills = "".join(f"<li><span>{s}</span></li>" for s in p["skills"])
+    languages = "".join(f"<li>{l} — вільно</li>" for l in p["languages"])
+    return (f'<!DOCTYPE html><html><body><div id="resume_{resume_id}" class="card">'
+            f'<div class="mt-lg"><h1>{p["name"]}</h1><h2>{p["position"]}, {p["salary"]} грн</h2>'
+            f'<dl><dt>Вік:</dt><dd>{p["age"]} років</dd><dt>Місто проживання:</dt><dd>{p["city"]}</dd></dl></div>'
+            f'<h2>Досвід роботи</h2>{jobs}<h2>Освіта</h2>{education}'
+            f'<h2 class="mb-sm">Знання і навички</h2><ul>{skills}</ul>'
+            f'<h2>Знання мов</h2><ul>{languages}</ul></div></body></html>')
+
+
+def rabota_ua_listing(config, page):
+    first = (page - 1) * RABOTA_UA_PER_PAGE
+    ids = range(first, min(first + RABOTA_UA_PER_PAGE, config.resumes))
+    cards = "\n".join(
+        f'<alliance-employer-cvdb-cv-list-card><div><a href="/candidates/{20000000 + i}">'
+        f'<p>{person(i, config.seed)["position"]}</p></a><p>{person(i, config.seed)["city"]}</p></div>'
+        f'</alliance-employer-cvdb-cv-list-card>'
+        for i in ids
+    )
+    return (f'<!DOCTYPE html><html><body><alliance-root>'
+            f'<alliance-employer-cvdb-cv-list>{cards}</alliance-employer-cvdb-cv-list></alliance-root></body></html>')
+
+
+def rabota_ua_candidate(config, candidate_id):
+    p = person(candidate_id - 20000000, config.seed)
+    jobs = "".join(
+        f'<div class="santa-mt-20 santa-mb-20 760:santa-mb-40 last:santa-mb-0 ng-star-inserted"><h4>{title}</h4>'
+        f'<div><div>{company}</div><div><div><div>з {year} по {year + 2}</div><div>Розробка сервісів</div></div></div>'
+        f'</div></div>'
+        for title, company, year in p["jobs"]
+    )
+    education = "".join(f"<div><h4>{e}</h4><div><div>Комп'ютерні науки</div><div>{p['city']}</div></div></div>"
+                        for e in p["education"])
+    return (f'<!DOCTYPE html><html><body>'
+            f'<div class="main-info-wrapper"><h1>{p["name"]}</h1><p>{p["position"]}</p>'
+            f'<div class="santa-mt-20">Повна зайнятість</div></div><article>'
+            f'<section><h3>Працював</h3>{jobs}</section>'
+            f'<section><h3>Навчався</h3>{education}</section>'
+            f'<section><h3>Ключова інформація</h3><div>{"".join(f"<p>{s}</p>" for s in p["skills"])}</div></section>'
+            f'<section><h3>Володіє мовами</h3><div>{"".join(f"<h4>{l}</h4>" for l in p["languages"])}</div></section>'
+            f'</article><script>fetch("/rabota_ua/api/resumes/{candidate_id}")</script></body></html>')
+
+
+def rabota_ua_candidate_json(config, candidate_id):
+    """Resume payload of the candidate page, holds the same resume as rabota_ua_candidate"""
+    p = person(candidate_id - 20000000, config.seed)
+    return {"resume": {
+        "resumeId": candidate_id,
+        "fullName": p["name"],
+        "speciality": p["position"],
+        "cityName": p["city"],
+        "scheduleName": "Повна зайнятість",
+        "experiences": [
+            {"position": title, "company": company, "period": f"з {year} по {year + 2}",
+             "description": "Розробка сервісів"}
+            for title, company, year in p["jobs"]
+        ],
+        "educations": [
+            {"name": e, "speciality": "Комп'ютерні науки", "location": p["city"], "yearOfGraduation": None}
+            for e in p["education"]
+        ],
+        "skills": [{"id": i, "name": s} for i, s in enumerate(p["skills"])],
+        "languages": [{"name": l, "levelName": "вільно"} for l in p["languages"]],
+    }}
+
+
+class MockBoard:
+    """aiohttp application serving both sites under /work_ua and /rabota_ua, counts served responses by status"""
+
+    def __init__(self, config=None):
+        self.config = config or BoardConfig()
+        self.statuses = Counter()
+        self.window_started = time.monotonic()
+        self.window_requests = 0
+        self.app = web.Application(middlewares=[self.__faults])
+        self.app.router.add_get("/work_ua/resumes/{resume_id:\\d+}/", self.__work_ua_resume)
+        self.app.router.add_get("/work_ua/resumes{query:[^/]*}/", self.__work_ua_listing)
+        self.app.router.add_get("/rabota_ua/candidates/{candidate_id:\\d+}", self.__rabota_ua_candidate)
+        self.app.router.add_get("/rabota_ua/ru/candidates/{position}/{city}", self.__rabota_ua_listing)
+        self.app.router.add_get("/rabota_ua/api/resumes/{candidate_id:\\d+}", self.__rabota_ua_candidate_json)
+        self.app.router.add_get("/stats", self.__stats)
+
+    def __throttled(self):
+        if not self.config.rate_limit:
+            return False
+        now = time.monotonic()
+        if now - self.window_started >= 1:
+            self.window_started, self.window_requests = now, 0
+        self.window_requests += 1
+        return self.window_requests > self.config.rate_limit
+
+    @web.middleware
+    async def __faults(self, request, handler):
+        if request.path == "/stats":
+            return await handler(request)
+        config = self.config
+        await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        if self.__throttled():
+            response = web.Response(status=429, headers={"Retry-After": "1"})
+        elif random.random() < config.error_rate:
+            response = web.Response(status=500)
+        else:
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                response = e
+        self.statuses[response.status] += 1
+        return response
+
+    @staticmethod
+    def page(request):
+        return int(request.query.get("page", 1))
+
+    async def __work_ua_listing(self, request):
+        return web.Response(text=work_ua_listing(self.config, self.page(request)), content_type="text/html")
+
+    async def __work_ua_resume(self, request):
+        resume_id = int(request.match_info["resume_id"])
+        if not 0 <= resume_id - 1000000 < self.config.resumes:
+            raise web.HTTPNotFound()
+        return web.Response(text=work_ua_resume(self.config, resume_id), content_type="text/html")
+
+    async def __rabota_ua_listing(self, request):
+        # the real SPA renders an empty list that only a browser can tell apart from a page not rendered yet
+        page = self.page(request)
+        if page > 1 and (page - 1) * RABOTA_UA_PER_PAGE >= self.config.resumes:
+            raise web.HTTPNotFound()
+        return web.Response(text=rabota_ua_listing(self.config, self.page(request)), content_type="text/html")
+
+    async def __rabota_ua_candidate(self, request):
+        candidate_id = int(request.match_info["candidate_id"])
+        if not 0 <= candidate_id - 20000000 < self.config.resumes:
+            raise web.HTTPNotFound()
+        return web.Response(text=rabota_ua_candidate(self.config, candidate_id), content_type="text/html")
+
+    async def __rabota_ua_candidate_json(self, request):
+        candidate_id = int(request.match_info["candidate_id"])
+        if not 0 <= candidate_id - 20000000 < self.config.resumes:
+            raise web.HTTPNotFound()
+        return web.json_response(rabota_ua_candidate_json(self.config, candidate_id))
+
+    async def __stats(self, request):
+        return web.json_response({str(k): v for k, v in self.statuses.items()})
+
+
+class MockBoardServer:
+    """Runs MockBoard on its own event loop in a background thread
+
+    with MockBoardServer(BoardConfig(resumes=1000)) as server:
+        WorkuaParser(site_url=server.url + "/work_ua")
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.board = MockBoard(config)
+        self.host = host
+        self.port = port
+        self.url = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.runner = None
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.__start(), self.loop).result()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def __start(self):
+        self.runner = web.AppRunner(self.board.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{self.host}:{self.port}"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--resumes", type=int, default=500, help="resumes served by each site")
+    arg_parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    arg_parser.add_argument("--jitter", type=float, default=0.02)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0, help="share of responses failing with 500")
+    arg_parser.add_argument("--rate-limit", type=int, default=0, help="requests per second before 429, 0 is unlimited")
+    arg_parser.add_argument("--file-resume-share", type=float, default=0.25)
+    args = arg_parser.parse_args()
+
+    config = BoardConfig(args.resumes, args.latency, args.jitter, args.error_rate, args.rate_limit,
+                         args.file_resume_share)
+    web.run_app(MockBoard(config).app, host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Offline benchmarks of parsing, url building, scoring and export on the saved html corpus
+
+Pages come from golden/ and benchmarks/corpus/, nothing is downloaded and no database is needed.
+Results are written as json, pass a previous result as --baseline to get the slowdown of every case.
+Allocations are measured with tracemalloc, so memory allocated inside lxml/libxml2 is not counted
+
+>> python -m benchmarks.run --output bench.json
+>> python -m benchmarks.run --baseline bench.json --output new.json
+"""
+import argparse
+import contextlib
+import copy
+import functools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+from database_manager import HistoryExporter, MarksManager
+from parsers import HTML_BACKENDS, RabotaUa, WorkuaParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIRS = (os.path.join(ROOT_DIR, "golden"), os.path.join(ROOT_DIR, "benchmarks", "corpus"))
+
+WORK_UA_QUERY = {
+    "position": ["python", "developer"],
+    "city": "київ",
+    "employment": ["full_time"],
+    "salary_from": "30000",
+    "salary_to": "60000",
+    "language": ["eng", "ua"],
+    "experience": ["1_3_years", "3_5_years"],
+}
+RABOTA_UA_QUERY = {
+    "position": ["python", "developer"],
+    "city": "Київ",
+    "employment": "full_time",
+    "salary_from": "30000",
+    "language": ["eng"],
+    "experience": ["3_5_years"],
+}
+
+
+def load_corpus():
+    corpus = {}
+    for corpus_dir in CORPUS_DIRS:
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.endswith(".html"):
+                with open(os.path.join(corpus_dir, name), encoding="utf-8") as f:
+                    corpus[name[:-len(".html")]] = f.read()
+    return corpus
+
+
+class CorpusDataBase:
+    """Stands in for DataBaseManager in the excel export, serves prepared candidates of one date"""
+    # (resource, query) -> candidates
+    candidates = {}
+
+    def fetch_runs(self, date_key):
+        return [{"date_key": date_key, "resource": resource, "query": query,
+                 "fields": list(dict.fromkeys(k for c in candidates for k in c if k != "mark"))}
+                for (resource, query), candidates in CorpusDataBase.candidates.items()]
+
+    def iter_candidates(self, run, batch_size=500):
+        for candidate in CorpusDataBase.candidates[run["resource"], run["query"]]:
+            yield copy.deepcopy(candidate)
+
+
+def work_ua_link(page_text):
+    return BeautifulSoup(page_text, "lxml").find("link", {"rel": "canonical"}).get("href")
+
+
+def build_cases(corpus):
+    """name -> (callable, items per call), inputs are prepared here so only the measured step is timed"""
+    cases = {}
+    resume_pages = sorted(name for name in corpus if name.startswith("work_ua.resume"))
+    candidate_pages = sorted(name for name in corpus if name.startswith("rabota_ua.candidate"))
+
+    for name in resume_pages:
+        page_text = corpus[name]
+        link = work_ua_link(page_text)
+        soup = BeautifulSoup(page_text, "lxml")
+        file_block = soup.find("div", {"class": "wordwrap", "id": "add_info"})
+        if file_block:
+            cases[f"work_ua.plain_text_parser[{name}]"] = (
+                lambda block=file_block: WorkuaParser.plain_text_parser(block, {}), 1
+            )
+        else:
+            block = soup.find("div", {"id": f"resume_{link.split('/')[-2]}"})
+            cases[f"work_ua.work_ua_template_parser[{name}]"] = (
+                lambda block=block, link=link: WorkuaParser.work_ua_template_parser(block, {"link": link}), 1
+            )
+        for backend_name, backend in HTML_BACKENDS.items():
+            cases[f"work_ua.parse_candidate_page.{backend_name}[{name}]"] = (
+                lambda backend=backend, page_text=page_text, link=link: backend.work_ua_resume(page_text, link), 1
+            )
+
+    for backend_name, backend in HTML_BACKENDS.items():
+        cases[f"work_ua.listing.{backend_name}"] = (
+            lambda backend=backend: backend.work_ua_listing(corpus["work_ua.listing"]), 1
+        )
+
+    for name in candidate_pages:
+        soup = BeautifulSoup(corpus[name], "lxml")
+        cases[f"rabota_ua.parse_candidate[{name}]"] = (lambda soup=soup: RabotaUa.parse_candidate(soup), 1)
+        for backend_name, backend in HTML_BACKENDS.items():
+            cases[f"rabota_ua.parse_candidate_page.{backend_name}[{name}]"] = (
+                lambda backend=backend, page_text=corpus[name]: backend.rabota_ua_candidate(page_text, "link"), 1
+            )
+
+    listing_soup = BeautifulSoup(corpus["rabota_ua.listing"], "lxml")
+    cases["rabota_ua.get_candidates_links"] = (lambda: RabotaUa.get_candidates_links(listing_soup), 1)
+
+    cases["work_ua.prepare_url"] = (lambda: WorkuaParser()._WorkuaParser__prepare_url(WORK_UA_QUERY), 1)
+    cases["rabota_ua.prepare_url"] = (lambda: RabotaUa()._RabotaUa__prepare_url(RABOTA_UA_QUERY), 1)
+
+    # scoring and export run on a day of 500 candidates per resource built from the corpus
+    work_ua_candidates = [HTML_BACKENDS["bs4"].work_ua_resume(corpus[name], work_ua_link(corpus[name]))
+                          for name in resume_pages] * (500 // len(resume_pages))
+    rabota_ua_candidates = [HTML_BACKENDS["bs4"].rabota_ua_candidate(corpus[name], "link")
+                            for name in candidate_pages] * (500 // len(candidate_pages))
+    marks = MarksManager()
+    cases["marks.count_mark_workua"] = (
+        lambda: [marks.count_mark_workua(c) for c in work_ua_candidates], len(work_ua_candidates)
+    )
+    cases["marks.count_mark_rabotaua"] = (
+        lambda: [marks.count_mark_rabotaua(c) for c in rabota_ua_candidates], len(rabota_ua_candidates)
+    )
+
+    by_mark = functools.partial(sorted, key=lambda c: c["mark"], reverse=True)
+    CorpusDataBase.candidates = {
+        ("WORK_UA", "python developer"): by_mark(dict(c, mark=marks.count_mark_workua(c)) for c in work_ua_candidates),
+        ("RABOTA_UA", "python developer"): by_mark(dict(c, mark=marks.count_mark_rabotaua(c)) for c in rabota_ua_candidates),
+    }
+    cases["excel.export"] = (
+        lambda: HistoryExporter(CorpusDataBase()).export("01.01.2024"),
+        len(work_ua_candidates) + len(rabota_ua_candidates)
+    )
+    return cases
+
+
+def measure(func, min_time, min_runs=5):
+    func()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - started < min_time:
+        t = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return timings, peak - base, current - base
+
+
+def run(cases, min_time, only=None):
+    results = {}
+    for name, (func, items) in cases.items():
+        if only and only not in name:
+            continue
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            timings, peak, retained = measure(func, min_time)
+        mean = statistics.mean(timings)
+        results[name] = {
+            "runs": len(timings),
+            "items_per_call": items,
+            "mean_ms": mean * 1000,
+            "median_ms": statistics.median(timings) * 1000,
+            "min_ms": min(timings) * 1000,
+            "items_per_sec": items / mean,
+            "peak_alloc_kb": peak / 1024,
+            "retained_kb": retained / 1024,
+        }
+        print(f"{name:<75} {mean * 1000:>10.3f} ms {items / mean:>12.1f} items/s {peak / 1024:>10.1f} KiB peak")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints every case slower or heavier than baseline by more than threshold, returns amount of regressions"""
+    regressions = 0
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        time_ratio = result["median_ms"] / base["median_ms"] if base["median_ms"] else 1
+        alloc_ratio = result["peak_alloc_kb"] / base["peak_alloc_kb"] if base["peak_alloc_kb"] else 1
+        result["baseline_time_ratio"] = time_ratio
+        result["baseline_alloc_ratio"] = alloc_ratio
+        if time_ratio > 1 + threshold or alloc_ratio > 1 + threshold:
+            regressions += 1
+            print(f"REGRESSION {name}: time x{time_ratio:.2f}, peak alloc x{alloc_ratio:.2f}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--output", help="file to write json results to")
+    arg_parser.add_argument("--baseline", help="json results of a previous run to compare with")
+    arg_parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    arg_parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run every case for")
+    arg_parser.add_argument("--only", help="run cases whose name contains this string")
+    args = arg_parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cases = build_cases(load_corpus())
+    results = run(cases, args.min_time, args.only)
+
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Golden files of the html backends
+
+Every golden/<kind>.<case>.html page is parsed by every backend of HTML_BACKENDS and compared with
+golden/<kind>.<case>.json by tests/test_backends.py, --update rewrites the expected files from the bs4 backend
+
+>> python -m pytest tests/test_backends.py
+>> python check_backends.py --update
+"""
+import json
+import os
+import re
+import sys
+
+from parsers import HTML_BACKENDS
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+canonical_pattern = re.compile(r'<link rel="canonical" href="([^"]+)">')
+
+
+def golden_pages():
+    """(file name, backend method) of every golden page"""
+    return [(name, "_".join(name.split(".")[:2])) for name in sorted(os.listdir(GOLDEN_DIR)) if name.endswith(".html")]
+
+
+def read_page(name):
+    """(page text, link) of the golden page, the link is taken from its canonical tag"""
+    with open(os.path.join(GOLDEN_DIR, name), encoding="utf-8") as f:
+        page_text = f.read()
+    return page_text, canonical_pattern.search(page_text).group(1)
+
+
+def expected_path(name):
+    return os.path.join(GOLDEN_DIR, name[:-len(".html")] + ".json")
+
+
+def run_backend(backend, method, page_text, link):
+    parse = getattr(backend, method)
+    try:
+        if method.endswith("_listing"):
+            links, pages = parse(page_text)
+            return {"links": links, "pages": pages}
+        return parse(page_text, link)
+    except Exception as e:
+        return {"error": type(e).__name__}
+
+
+def normalize(result):
+    """Tuples become lists the way they do after json round trip"""
+    return json.loads(json.dumps(result, ensure_ascii=False))
+
+
+def update():
+    for name, method in golden_pages():
+        page_text, link = read_page(name)
+        with open(expected_path(name), "w", encoding="utf-8") as f:
+            json.dump(normalize(run_backend(HTML_BACKENDS["bs4"], method, page_text, link)), f,
+                      ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"updated {expected_path(name)}")
+
+
+if __name__ == "__main__":
+    if "--update" not in sys.argv:
+        sys.exit(__doc__)
+    update()
@@ -1 +1,18 @@
 API_KEY = ""
+
+# Telegram ids of users allowed to use /stats
+ADMIN_IDS = []
+
+# Prometheus metrics endpoint, None port disables it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Directory of the on-disk response cache, None disables caching
+RESPONSE_CACHE_DIR = None
+RESPONSE_CACHE_MAX_MB = 512
+
+# Don't fetch resumes stored during the last SeenIndex.refresh_days again, their stored version is used
+INCREMENTAL_CRAWL = False
+
+# How robota.ua candidates are read: "dom" parses the rendered page, "network" the resume JSON the page loads
+RABOTA_UA_EXTRACTION_MODE = "dom"
@@ -1,9 +1,79 @@
-from pymongo import MongoClient
-from datetime import datetime
-import pandas as pd
+from bson import ObjectId
+from pymongo import DeleteMany, InsertOne, MongoClient, ReplaceOne, UpdateOne, WriteConcern
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
+from metrics import Metrics
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+import asyncio
+import hashlib
+import io
+import itertools
+import logging
+import math
+import re
+import threading
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
 
 
 class DataBaseManager:
+    """Access to one collection and to the candidate history through a MongoClient shared by the whole process
+
+    One pooled client is opened per connection url on first use and kept until close_clients(),
+    entering the manager only takes the collections from it.
+    History is stored as one document per crawl of a query in the runs collection and one entry per candidate
+    per run in the candidates collection. Entries keep the mark and refer to a profile, the one canonical record
+    of a person in the profiles collection matched by CandidateIdentity keys, so a resume found by many queries,
+    dates or on both sites is stored once. A query crawled again the same day gets a run of its own, readers
+    take the latest started complete run of the query and finish_run drops the runs it supersedes. Cancelled
+    and failed runs are kept as partial runs and read only when the query has no complete run that day.
+    See migrate_history.py for the old one document per date layout
+    """
+    # Shared client settings
+    max_pool_size = 50
+    min_pool_size = 0
+    max_idle_time_ms = 60000
+    connect_timeout_ms = 5000
+    server_selection_timeout_ms = 5000
+    socket_timeout_ms = 30000
+    heartbeat_frequency_ms = 10000
+
+    # Candidate writes, write_concern is passed to WriteConcern, empty means the server default
+    write_batch_size = 500
+    write_concern = {}
+    write_retries = 3
+    write_retry_delay = 0.5
+
+    candidates_collection = "candidates"
+    runs_collection = "runs"
+    profiles_collection = "profiles"
+    # runs in these statuses are still being written, readers skip them and finish_run never drops them
+    active_statuses = ("running", "migrating")
+    # runs that crawled the whole query, only these replace earlier runs of it
+    complete_statuses = ("done", "migrated")
+    indexes = {
+        # candidates of a run sorted by mark
+        "candidates": [
+            [("run_id", 1), ("mark", -1)],
+            [("resource", 1), ("date", 1)],
+            [("profile_id", 1)],
+        ],
+        "runs": [
+            [("date_key", 1), ("resource", 1), ("query", 1)],
+            [("date", -1)],
+        ],
+        "profiles": [
+            [("keys", 1)],
+        ],
+    }
+
+    _clients = {}
+    _clients_lock = threading.Lock()
 
     def __init__(self, conn_url="mongodb://localhost:27017", db_name="parsed_resumes", collection_name="parsing_results"):
         self.conn_url = conn_url
@@ -11,30 +81,297 @@ class DataBaseManager:
         self.collection_name = collection_name
 
     def __enter__(self):
-        self.client = MongoClient(self.conn_url)
+        self.client = DataBaseManager.get_client(self.conn_url)
         self.db = self.client.get_database(self.db_name)
         self.collection = self.db.get_collection(self.collection_name)
+        self.candidates = self.db.get_collection(
+            DataBaseManager.candidates_collection, write_concern=WriteConcern(**DataBaseManager.write_concern)
+        )
+        self.runs = self.db.get_collection(DataBaseManager.runs_collection)
+        self.profiles = self.db.get_collection(
+            DataBaseManager.profiles_collection, write_concern=WriteConcern(**DataBaseManager.write_concern)
+        )
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.client.close()
+        return
 
-    def append_data(self, date_key, resource_name, query, data):
-        document = self.collection.find_one({"_id": date_key})
+    @staticmethod
+    def configure(max_pool_size=None, min_pool_size=None, max_idle_time_ms=None, connect_timeout_ms=None,
+                  server_selection_timeout_ms=None, socket_timeout_ms=None, write_batch_size=None,
+                  write_concern=None, write_retries=None):
+        """Change client and write settings, already opened clients are closed and recreated on next use"""
+        if max_pool_size is not None:
+            DataBaseManager.max_pool_size = max_pool_size
+        if min_pool_size is not None:
+            DataBaseManager.min_pool_size = min_pool_size
+        if max_idle_time_ms is not None:
+            DataBaseManager.max_idle_time_ms = max_idle_time_ms
+        if connect_timeout_ms is not None:
+            DataBaseManager.connect_timeout_ms = connect_timeout_ms
+        if server_selection_timeout_ms is not None:
+            DataBaseManager.server_selection_timeout_ms = server_selection_timeout_ms
+        if socket_timeout_ms is not None:
+            DataBaseManager.socket_timeout_ms = socket_timeout_ms
+        if write_batch_size is not None:
+            DataBaseManager.write_batch_size = write_batch_size
+        if write_concern is not None:
+            DataBaseManager.write_concern = write_concern
+        if write_retries is not None:
+            DataBaseManager.write_retries = write_retries
+        DataBaseManager.close_clients()
 
-        if not document:
-            new_document = {
-                "_id": date_key,
-                resource_name: {
-                    query: data
-                }
-            }
-            self.collection.insert_one(new_document)
-        else:
-            update_query = {
-                "$set": {f"{resource_name}.{query}": data}
+    @staticmethod
+    def get_client(conn_url):
+        with DataBaseManager._clients_lock:
+            client = DataBaseManager._clients.get(conn_url)
+            if client is None:
+                client = MongoClient(
+                    conn_url,
+                    maxPoolSize=DataBaseManager.max_pool_size,
+                    minPoolSize=DataBaseManager.min_pool_size,
+                    maxIdleTimeMS=DataBaseManager.max_idle_time_ms,
+                    connectTimeoutMS=DataBaseManager.connect_timeout_ms,
+                    serverSelectionTimeoutMS=DataBaseManager.server_selection_timeout_ms,
+                    socketTimeoutMS=DataBaseManager.socket_timeout_ms,
+                    heartbeatFrequencyMS=DataBaseManager.heartbeat_frequency_ms
+                )
+                DataBaseManager._clients[conn_url] = client
+        return client
+
+    @staticmethod
+    def health_check(conn_url="mongodb://localhost:27017"):
+        """Pings the server through the shared client, returns (ok, round trip in ms or error type)"""
+        started = time.perf_counter()
+        try:
+            DataBaseManager.get_client(conn_url).admin.command("ping")
+        except PyMongoError as e:
+            logger.error(f"MongoDB at {conn_url} is not available: {e}")
+            return False, type(e).__name__
+        return True, (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def close_clients():
+        with DataBaseManager._clients_lock:
+            for client in DataBaseManager._clients.values():
+                client.close()
+            DataBaseManager._clients.clear()
+
+    @staticmethod
+    def date_of(date_key):
+        return datetime.strptime(date_key, "%d.%m.%Y")
+
+    @staticmethod
+    def sorted_dates(date_keys):
+        return sorted(date_keys, key=DataBaseManager.date_of)
+
+    @staticmethod
+    def latest_runs(runs):
+        """Latest started complete run of every resource and query, sorted by resource and query
+
+        The latest partial run stands in for a query with no complete run. started_at is stored with
+        millisecond precision, runs started within the same millisecond go by _id
+        """
+        latest, partial = {}, {}
+        for run in sorted(runs, key=lambda r: (r.get("started_at") or datetime.min, r["_id"])):
+            status = run.get("status")
+            if status in DataBaseManager.complete_statuses:
+                latest[run["resource"], run["query"]] = run
+            elif status not in DataBaseManager.active_statuses:
+                partial[run["resource"], run["query"]] = run
+        latest = {**partial, **latest}
+        return [latest[key] for key in sorted(latest)]
+
+    @staticmethod
+    def join_profiles(entries, profiles, resource_name):
+        """Candidates of the entries as they are stored in their profiles, with the mark of the entry"""
+        data = {profile["_id"]: profile.get("data", {}).get(resource_name, {}) for profile in profiles}
+        return [dict(data.get(entry["profile_id"], {"link": entry.get("link")}), mark=entry.get("mark"),
+                     profile_id=entry["profile_id"]) for entry in entries]
+
+    @staticmethod
+    def new_run(date_key, resource_name, query, status):
+        return {"_id": ObjectId(), "date_key": date_key, "resource": resource_name, "query": query,
+                "date": DataBaseManager.date_of(date_key), "status": status, "stored": 0,
+                "started_at": datetime.now(), "finished_at": None}
+
+    @staticmethod
+    def query_runs(run):
+        """Filter of the finished runs of the query and day of run"""
+        return {"date_key": run["date_key"], "resource": run["resource"], "query": run["query"],
+                "status": {"$nin": list(DataBaseManager.active_statuses)}}
+
+    @staticmethod
+    def runs_to_drop(finished):
+        """Ids of the finished runs started before the latest complete one, finished go latest started first"""
+        latest = next(i for i, r in enumerate(finished) if r["status"] in DataBaseManager.complete_statuses)
+        return [r["_id"] for r in finished[latest + 1:]]
+
+    @staticmethod
+    def store_requests(run, candidates, identities, profile_ids):
+        """(profile writes, entry writes, fields) of a batch of candidates matched to their profiles"""
+        resource_name = run["resource"]
+        # columns of the run in the order fields first appear, the export writes its header from them
+        fields = list(dict.fromkeys(k for candidate in candidates for k in candidate if k not in ("_id", "mark")))
+        profiles, entries = {}, {}
+        for candidate, keys, profile_id in zip(candidates, identities, profile_ids):
+            data = {k: v for k, v in candidate.items() if k not in ("_id", "mark")}
+            profile = profiles.setdefault(profile_id, {"keys": set(), "data": data})
+            profile["keys"].update(keys)
+            entry_id = f"{run['_id']}:{profile_id}"
+            # a resume met twice in one run is stored once with its best mark
+            if entry_id in entries and (entries[entry_id]["mark"] or 0) >= (candidate.get("mark") or 0):
+                continue
+            profile["data"] = data
+            entries[entry_id] = {
+                "_id": entry_id, "run_id": run["_id"], "profile_id": profile_id, "link": candidate.get("link"),
+                "mark": candidate.get("mark"), **{k: run[k] for k in ("date_key", "date", "resource", "query")}
             }
-            self.collection.update_one({"_id": date_key}, update_query)
+
+        # data of a resource is replaced only by a run of the same or a later date, so migrating or re-running
+        # an old date never overwrites a newer version of the resume
+        data_date = f"data_dates.{resource_name}"
+        requests = []
+        for profile_id, profile in profiles.items():
+            requests.append(UpdateOne({"_id": profile_id}, {
+                "$addToSet": {"keys": {"$each": sorted(profile["keys"])}, "resources": resource_name},
+                "$min": {"first_seen": run["date"]},
+                "$max": {"last_seen": run["date"]},
+            }, upsert=True))
+            requests.append(UpdateOne(
+                {"_id": profile_id, "$or": [{data_date: {"$lte": run["date"]}}, {data_date: {"$exists": False}}]},
+                {"$set": {f"data.{resource_name}": profile["data"], data_date: run["date"]}}
+            ))
+        entry_requests = [ReplaceOne({"_id": entry_id}, entry, upsert=True) for entry_id, entry in entries.items()]
+        return requests, entry_requests, fields
+
+    @staticmethod
+    def link_keys(resource_name, links, resume_id=None):
+        """{strongest key: link} of the links"""
+        return {CandidateIdentity.keys(resource_name, {"link": link}, resume_id)[0]: link for link in links}
+
+    @staticmethod
+    def stored_by_link(resource_name, keys, profiles):
+        """{link: candidate} of the profiles found by link_keys"""
+        stored = {}
+        for profile in profiles:
+            data = profile.get("data", {}).get(resource_name)
+            if not data:
+                continue
+            for key in profile["keys"]:
+                if key in keys:
+                    stored[keys[key]] = dict(data, link=keys[key])
+        return stored
+
+    @staticmethod
+    def write_retry(e, attempt):
+        """Whether a failed bulk_write attempt is tried again"""
+        retryable = isinstance(e, ConnectionFailure) or e.has_error_label("RetryableWriteError")
+        return retryable and attempt < DataBaseManager.write_retries
+
+    def ensure_indexes(self):
+        for collection_name, indexes in DataBaseManager.indexes.items():
+            for keys in indexes:
+                self.db.get_collection(collection_name).create_index(keys)
+
+    def bulk_write(self, collection, requests, ordered=False):
+        """collection.bulk_write retried write_retries times on network errors and retryable write errors
+
+        Requests have to be idempotent, profiles and entries get their _id before the first attempt, so a retry
+        rewrites what a failed attempt already wrote instead of duplicating it
+        """
+        for attempt in range(DataBaseManager.write_retries + 1):
+            try:
+                return collection.bulk_write(requests, ordered=ordered)
+            except (ConnectionFailure, OperationFailure) as e:
+                if not DataBaseManager.write_retry(e, attempt):
+                    raise
+                Metrics.retry(self.conn_url, type(e).__name__)
+                logger.warning(f"Write to {collection.name} failed with {type(e).__name__}, retry {attempt + 1}")
+                time.sleep(DataBaseManager.write_retry_delay * 2 ** attempt)
+
+    def start_run(self, date_key, resource_name, query, status="running"):
+        """Records a crawl of query, earlier runs of the query that day are left to finish_run"""
+        with Metrics.timer("persist", operation="start_run"):
+            run = DataBaseManager.new_run(date_key, resource_name, query, status)
+            self.bulk_write(self.runs, [InsertOne(run)])
+            return run
+
+    def store_candidates(self, run, candidates, resume_id=None):
+        """Merges candidates of the run into profiles and stores one entry per profile of the run
+
+        Every write_batch_size candidates take one lookup of known profiles and one bulk_write of profiles and
+        of entries, resume_id is the id getter of the resource parser
+        """
+        for i in range(0, len(candidates), DataBaseManager.write_batch_size):
+            with Metrics.timer("persist", operation="bulk_upsert"):
+                self.__store_batch(run, candidates[i:i + DataBaseManager.write_batch_size], resume_id)
+
+    def __store_batch(self, run, candidates, resume_id):
+        resource_name = run["resource"]
+        identities = [CandidateIdentity.keys(resource_name, c, resume_id) for c in candidates]
+        lookups = {key for keys in identities for key in CandidateIdentity.lookup_keys(keys)}
+        known = self.profiles.find({"keys": {"$in": list(lookups)}}, {"keys": 1, "resources": 1})
+        profile_ids = CandidateIdentity.match(resource_name, identities, known)
+        profile_writes, entry_writes, fields = DataBaseManager.store_requests(run, candidates, identities, profile_ids)
+        self.bulk_write(self.profiles, profile_writes, ordered=True)
+        self.bulk_write(self.candidates, entry_writes)
+        self.runs.update_one({"_id": run["_id"]}, {"$addToSet": {"fields": {"$each": fields}}})
+
+    def finish_run(self, run_id, status="done"):
+        """Sets the status of the run, stored is counted from the candidates so retried batches count once
+
+        A complete run then drops every finished run of the query that day started before the latest complete
+        one. Runs still running are never touched, a run that started earlier but finishes later drops itself.
+        Cancelled and failed runs drop nothing, a crawl cut short never replaces a full one
+        """
+        stored = self.candidates.count_documents({"run_id": run_id})
+        run = self.runs.find_one_and_update(
+            {"_id": run_id}, {"$set": {"status": status, "stored": stored, "finished_at": datetime.now()}}
+        )
+        if not run or status not in DataBaseManager.complete_statuses:
+            return
+        finished = self.runs.find(DataBaseManager.query_runs(run), {"status": 1})
+        self.drop_runs(DataBaseManager.runs_to_drop(list(finished.sort([("started_at", -1), ("_id", -1)]))))
+
+    def drop_runs(self, run_ids):
+        """Removes the runs with their candidates, candidates go first so a run is never left without them"""
+        if not run_ids:
+            return
+        with Metrics.timer("persist", operation="drop_runs"):
+            self.bulk_write(self.candidates, [DeleteMany({"run_id": {"$in": run_ids}})])
+            self.bulk_write(self.runs, [DeleteMany({"_id": {"$in": run_ids}})])
+        logger.info(f"Dropped {len(run_ids)} superseded runs")
+
+    def fetch_dates(self):
+        return DataBaseManager.sorted_dates(
+            self.runs.distinct("date_key", {"status": {"$nin": list(DataBaseManager.active_statuses)}})
+        )
+
+    def fetch_runs(self, date_key):
+        """Latest finished run of every query crawled that day"""
+        return DataBaseManager.latest_runs(self.runs.find({"date_key": date_key}))
+
+    def fetch_candidates(self, run, limit=0):
+        """Candidates of the run sorted by mark, limit=N gives the top N
+
+        Candidate data comes from the profile, so it is the latest version parsed from the resume
+        """
+        entries = list(self.candidates.find({"run_id": run["_id"]}).sort("mark", -1).limit(limit))
+        profiles = self.profiles.find({"_id": {"$in": [entry["profile_id"] for entry in entries]}})
+        return DataBaseManager.join_profiles(entries, profiles, run["resource"])
+
+    def iter_candidates(self, run, batch_size=500):
+        """Same as fetch_candidates without a limit, holds only batch_size candidates at a time"""
+        resource_name = run["resource"]
+        cursor = self.candidates.find(
+            {"run_id": run["_id"]}, {"profile_id": 1, "link": 1, "mark": 1}
+        ).sort("mark", -1).batch_size(batch_size)
+        while entries := list(itertools.islice(cursor, batch_size)):
+            profiles = self.profiles.find(
+                {"_id": {"$in": [entry["profile_id"] for entry in entries]}}, {f"data.{resource_name}": 1}
+            )
+            yield from DataBaseManager.join_profiles(entries, profiles, resource_name)
 
     def fetch_data(self, date_key):
         document = self.collection.find_one({"_id": date_key})
@@ -48,6 +385,324 @@ class DataBaseManager:
         ids = self.collection.find({}, {"_id": 1})
         return [doc["_id"] for doc in ids]
 
+    def fetch_stored_candidates(self, resource_name, links, resume_id=None):
+        """{link: candidate} of the links as they are stored in their profiles, unknown resumes are left out"""
+        keys = DataBaseManager.link_keys(resource_name, links, resume_id)
+        profiles = self.profiles.find({"keys": {"$in": list(keys)}}, {"keys": 1, f"data.{resource_name}": 1})
+        return DataBaseManager.stored_by_link(resource_name, keys, profiles)
+
+    def fetch_stored_links(self, resource_name, since=None, exclude_date_keys=()):
+        """Yields links of candidates stored for resource_name on dates not older than since"""
+        query = {"resource": resource_name, "link": {"$exists": True}}
+        if since:
+            query["date"] = {"$gte": since}
+        if exclude_date_keys:
+            query["date_key"] = {"$nin": list(exclude_date_keys)}
+        for document in self.candidates.find(query, {"link": 1, "_id": 0}):
+            if document.get("link"):
+                yield document["link"]
+
+
+class AsyncDataBaseManager:
+    """Motor counterpart of DataBaseManager for code running on the bot event loop
+
+    async with AsyncDataBaseManager() as db:
+        runs = await db.fetch_runs(date_key)
+
+    Clients are shared per connection url with the pool settings of DataBaseManager and are bound to the
+    loop that first used them, scripts and worker threads keep using DataBaseManager. Runs are written the same
+    way DataBaseManager writes them, so crawls on the event loop store candidates without blocking it
+    """
+    _clients = {}
+
+    def __init__(self, conn_url="mongodb://localhost:27017", db_name="parsed_resumes", collection_name="parsing_results"):
+        self.conn_url = conn_url
+        self.db_name = db_name
+        self.collection_name = collection_name
+
+    async def __aenter__(self):
+        self.client = AsyncDataBaseManager.get_client(self.conn_url)
+        self.db = self.client.get_database(self.db_name)
+        self.collection = self.db.get_collection(self.collection_name)
+        self.candidates = self.db.get_collection(
+            DataBaseManager.candidates_collection, write_concern=WriteConcern(**DataBaseManager.write_concern)
+        )
+        self.runs = self.db.get_collection(DataBaseManager.runs_collection)
+        self.profiles = self.db.get_collection(
+            DataBaseManager.profiles_collection, write_concern=WriteConcern(**DataBaseManager.write_concern)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return
+
+    @staticmethod
+    def get_client(conn_url):
+        client = AsyncDataBaseManager._clients.get(conn_url)
+        if client is None:
+            client = AsyncIOMotorClient(
+                conn_url,
+                maxPoolSize=DataBaseManager.max_pool_size,
+                minPoolSize=DataBaseManager.min_pool_size,
+                maxIdleTimeMS=DataBaseManager.max_idle_time_ms,
+                connectTimeoutMS=DataBaseManager.connect_timeout_ms,
+                serverSelectionTimeoutMS=DataBaseManager.server_selection_timeout_ms,
+                socketTimeoutMS=DataBaseManager.socket_timeout_ms,
+                heartbeatFrequencyMS=DataBaseManager.heartbeat_frequency_ms
+            )
+            AsyncDataBaseManager._clients[conn_url] = client
+        return client
+
+    @staticmethod
+    async def health_check(conn_url="mongodb://localhost:27017"):
+        """Same as DataBaseManager.health_check without blocking the event loop"""
+        started = time.perf_counter()
+        try:
+            await AsyncDataBaseManager.get_client(conn_url).admin.command("ping")
+        except PyMongoError as e:
+            logger.error(f"MongoDB at {conn_url} is not available: {e}")
+            return False, type(e).__name__
+        return True, (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def close_clients():
+        for client in AsyncDataBaseManager._clients.values():
+            client.close()
+        AsyncDataBaseManager._clients.clear()
+
+    async def ensure_indexes(self):
+        for collection_name, indexes in DataBaseManager.indexes.items():
+            for keys in indexes:
+                await self.db.get_collection(collection_name).create_index(keys)
+
+    async def bulk_write(self, collection, requests, ordered=False):
+        """Same as DataBaseManager.bulk_write, waits between attempts without blocking the event loop"""
+        for attempt in range(DataBaseManager.write_retries + 1):
+            try:
+                return await collection.bulk_write(requests, ordered=ordered)
+            except (ConnectionFailure, OperationFailure) as e:
+                if not DataBaseManager.write_retry(e, attempt):
+                    raise
+                Metrics.retry(self.conn_url, type(e).__name__)
+                logger.warning(f"Write to {collection.name} failed with {type(e).__name__}, retry {attempt + 1}")
+                await asyncio.sleep(DataBaseManager.write_retry_delay * 2 ** attempt)
+
+    async def start_run(self, date_key, resource_name, query, status="running"):
+        with Metrics.timer("persist", operation="start_run"):
+            run = DataBaseManager.new_run(date_key, resource_name, query, status)
+            await self.bulk_write(self.runs, [InsertOne(run)])
+            return run
+
+    async def store_candidates(self, run, candidates, resume_id=None):
+        for i in range(0, len(candidates), DataBaseManager.write_batch_size):
+            with Metrics.timer("persist", operation="bulk_upsert"):
+                await self.__store_batch(run, candidates[i:i + DataBaseManager.write_batch_size], resume_id)
+
+    async def __store_batch(self, run, candidates, resume_id):
+        resource_name = run["resource"]
+        identities = [CandidateIdentity.keys(resource_name, c, resume_id) for c in candidates]
+        lookups = {key for keys in identities for key in CandidateIdentity.lookup_keys(keys)}
+        known = self.profiles.find({"keys": {"$in": list(lookups)}}, {"keys": 1, "resources": 1})
+        profile_ids = CandidateIdentity.match(resource_name, identities, await known.to_list(length=None))
+        profile_writes, entry_writes, fields = DataBaseManager.store_requests(run, candidates, identities, profile_ids)
+        await self.bulk_write(self.profiles, profile_writes, ordered=True)
+        await self.bulk_write(self.candidates, entry_writes)
+        await self.runs.update_one({"_id": run["_id"]}, {"$addToSet": {"fields": {"$each": fields}}})
+
+    async def finish_run(self, run_id, status="done"):
+        stored = await self.candidates.count_documents({"run_id": run_id})
+        run = await self.runs.find_one_and_update(
+            {"_id": run_id}, {"$set": {"status": status, "stored": stored, "finished_at": datetime.now()}}
+        )
+        if not run or status not in DataBaseManager.complete_statuses:
+            return
+        finished = self.runs.find(DataBaseManager.query_runs(run), {"status": 1})
+        finished = await finished.sort([("started_at", -1), ("_id", -1)]).to_list(length=None)
+        await self.drop_runs(DataBaseManager.runs_to_drop(finished))
+
+    async def drop_runs(self, run_ids):
+        if not run_ids:
+            return
+        with Metrics.timer("persist", operation="drop_runs"):
+            await self.bulk_write(self.candidates, [DeleteMany({"run_id": {"$in": run_ids}})])
+            await self.bulk_write(self.runs, [DeleteMany({"_id": {"$in": run_ids}})])
+        logger.info(f"Dropped {len(run_ids)} superseded runs")
+
+    async def fetch_stored_candidates(self, resource_name, links, resume_id=None):
+        keys = DataBaseManager.link_keys(resource_name, links, resume_id)
+        profiles = self.profiles.find({"keys": {"$in": list(keys)}}, {"keys": 1, f"data.{resource_name}": 1})
+        return DataBaseManager.stored_by_link(resource_name, keys, await profiles.to_list(length=None))
+
+    async def fetch_dates(self):
+        return DataBaseManager.sorted_dates(
+            await self.runs.distinct("date_key", {"status": {"$nin": list(DataBaseManager.active_statuses)}})
+        )
+
+    async def fetch_runs(self, date_key):
+        return DataBaseManager.latest_runs(await self.runs.find({"date_key": date_key}).to_list(length=None))
+
+    async def fetch_candidates(self, run, limit=0):
+        entries = await self.candidates.find({"run_id": run["_id"]}).sort("mark", -1).limit(limit).to_list(length=None)
+        profiles = self.profiles.find({"_id": {"$in": [entry["profile_id"] for entry in entries]}})
+        return DataBaseManager.join_profiles(entries, await profiles.to_list(length=None), run["resource"])
+
+    async def fetch_data(self, date_key):
+        return await self.collection.find_one({"_id": date_key})
+
+    async def fetch_all(self):
+        return await self.collection.find().to_list(length=None)
+
+    async def fetch_all_ids(self):
+        return [doc["_id"] async for doc in self.collection.find({}, {"_id": 1})]
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.__positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key))
+
+
+class SeenIndex:
+    """Resume ids stored during the last refresh_days, loaded once per run into a Bloom filter
+
+    Parsers skip detail fetches for links whose id is in the index and yield a reference instead, which
+    CandidatesPipeline fills from the stored profile, so the run still lists the resume. A false positive
+    (error_rate probability) refers to a resume that isn't stored, it is logged and left out of the run
+    """
+    refresh_days = 7
+    error_rate = 0.001
+
+    def __init__(self, ids, id_getter):
+        self.id_getter = id_getter
+        self.bloom = BloomFilter(len(ids), SeenIndex.error_rate)
+        for resume_id in ids:
+            self.bloom.add(resume_id)
+        self.size = len(ids)
+
+    @staticmethod
+    def load(db, resource_name, id_getter, refresh_days=None, exclude_date_keys=()):
+        since = datetime.now() - timedelta(days=refresh_days or SeenIndex.refresh_days)
+        ids = {id_getter(link) for link in db.fetch_stored_links(resource_name, since, exclude_date_keys)}
+        return SeenIndex(ids, id_getter)
+
+    def __contains__(self, link):
+        return self.id_getter(link) in self.bloom
+
+
+class CandidateIdentity:
+    """Keys a candidate is recognised by across runs, queries and sites
+
+    resume:<resource>:<id> and link:<url> match the same resume, fuzzy:<name>|<city>|<occupation> matches the
+    same person on the other site. Fuzzy keys are made only when the name and the city or the occupation are
+    known, the occupation falls back to the last position of job experience. robota.ua resumes have no city,
+    a candidate without one is stored under fuzzy:<name>||<occupation> and a candidate with one also under
+    fuzzy:<name>|*|<occupation>, so name and occupation alone match only when one of the two sides has no city
+    """
+    separators = re.compile(r"\W+")
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(CandidateIdentity.separators.sub(" ", str(text or "").casefold()).split())
+
+    @staticmethod
+    def link_key(link):
+        parts = urlsplit(link.strip())
+        host = parts.netloc.lower().removeprefix("www.")
+        return f"link:{host}{parts.path.rstrip('/')}"
+
+    @staticmethod
+    def fuzzy_keys(candidate):
+        name = " ".join(sorted(CandidateIdentity.normalize(candidate.get("name")).split()))
+        city = CandidateIdentity.normalize(candidate.get("living_city") or candidate.get("city"))
+        occupation = candidate.get("occupation")
+        if not occupation and isinstance(candidate.get("job_experience"), list) and candidate["job_experience"]:
+            job = candidate["job_experience"][0]
+            if isinstance(job, dict):
+                occupation = job.get("title") or job.get("position")
+        occupation = CandidateIdentity.normalize(occupation)
+        if not name or not (city or occupation):
+            return []
+        keys = [f"fuzzy:{name}|{city}|{occupation}"]
+        if city and occupation:
+            keys.append(f"fuzzy:{name}|*|{occupation}")
+        return keys
+
+    @staticmethod
+    def lookup_keys(keys):
+        """Keys to look a candidate up by, its stored keys with the city wildcard turned to the other side:
+        a candidate with a city looks for profiles without one and the other way round"""
+        lookups = []
+        for key in keys:
+            if not key.startswith("fuzzy:"):
+                lookups.append(key)
+                continue
+            name, city, occupation = key.removeprefix("fuzzy:").split("|")
+            if city == "*":
+                lookups.append(f"fuzzy:{name}||{occupation}")
+            elif not city and occupation:
+                lookups.extend((key, f"fuzzy:{name}|*|{occupation}"))
+            else:
+                lookups.append(key)
+        return lookups
+
+    @staticmethod
+    def keys(resource_name, candidate, resume_id=None):
+        """Keys of the candidate, strongest first"""
+        keys = []
+        link = candidate.get("link")
+        if link and resume_id:
+            keys.append(f"resume:{resource_name}:{resume_id(link.split('?')[0].split('#')[0])}")
+        if link:
+            keys.append(CandidateIdentity.link_key(link))
+        return keys + CandidateIdentity.fuzzy_keys(candidate)
+
+    @staticmethod
+    def match(resource_name, identities, known_profiles):
+        """Profile id of every candidate, new ids for candidates matching no known profile
+
+        A fuzzy key only matches a profile that has no resume from resource_name yet, so two people with the
+        same name on one site are never merged. A profile takes a resume from resource_name as soon as a
+        candidate of the batch is matched to it. Fuzzy keys leading to more than one profile are ambiguous,
+        a candidate is then given a profile of its own instead of whichever of them came first
+        """
+        owners, taken = {}, {}
+        for profile in known_profiles:
+            taken[profile["_id"]] = resource_name in profile.get("resources", ())
+            for key in profile["keys"]:
+                owners.setdefault(key, {})[profile["_id"]] = None
+        profile_ids = []
+        for keys in identities:
+            profile_id, fuzzy_owners = None, {}
+            for key in CandidateIdentity.lookup_keys(keys):
+                if key.startswith("fuzzy:"):
+                    fuzzy_owners.update(owners.get(key, {}))
+                elif key in owners:
+                    profile_id = next(iter(owners[key]))
+                    break
+            if profile_id is None and len(fuzzy_owners) == 1 and not taken[next(iter(fuzzy_owners))]:
+                profile_id = next(iter(fuzzy_owners))
+            profile_id = profile_id or ObjectId()
+            taken[profile_id] = True
+            for key in keys:
+                owners.setdefault(key, {})[profile_id] = None
+            profile_ids.append(profile_id)
+        return profile_ids
+
 
 class MarksManager:
     def __init__(self):
@@ -87,25 +742,86 @@ class MarksManager:
             self.weights_table["languages"] * len(languages)
 
 
-def save_parsing_history_to_excel(date_key):
-    with DataBaseManager() as db:
-        document = db.fetch_data(date_key)
-        if not document:
-            print(f"No data found for {date_key}")
-            return
-        names = []
-        for resource_name, queries in document.items():
-            if resource_name == "_id":
-                continue
-            for query, data in queries.items():
-                df = pd.DataFrame(data)
+class HistoryExporter:
+    """Streams parsing history of a date into xlsx files built in memory
+
+    Candidates are read batch_size at a time in mark order and appended to a write only openpyxl workbook,
+    which keeps rows in a temporary file of its own instead of memory. Files are returned as (filename, bytes),
+    more than zip_after of them are bundled into one zip. db is an entered DataBaseManager
+    """
+    batch_size = 500
+    zip_after = 3
+    # longest text an excel cell takes
+    max_cell_length = 32767
+
+    def __init__(self, db):
+        self.db = db
 
-                filename = f"{resource_name}_{date_key.replace('.', '')}_{query.replace(' ', '_')}.xlsx"
+    @staticmethod
+    def cell(value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        value = ILLEGAL_CHARACTERS_RE.sub("", value if isinstance(value, str) else str(value))
+        return value[:HistoryExporter.max_cell_length]
 
-                df.to_excel(filename, index=False)
-                print(f"Data for query '{query}' saved to {filename}")
-                names.append(filename)
-        return names
+    def columns(self, run):
+        """Header of the run, runs stored without their fields get them from a pass over the candidates"""
+        fields = run.get("fields")
+        if fields is None:
+            fields = dict.fromkeys(
+                k for candidate in self.db.iter_candidates(run, HistoryExporter.batch_size)
+                for k in candidate if k not in ("mark", "profile_id")
+            )
+        return [field for field in fields if field != "mark"] + ["mark"]
+
+    def workbook(self, run, exported):
+        """xlsx of one run, skips profiles of the query already written to another file of the date"""
+        columns = self.columns(run)
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Sheet1")
+        sheet.append(columns)
+        rows = 0
+        for candidate in self.db.iter_candidates(run, HistoryExporter.batch_size):
+            profile_id = candidate.pop("profile_id", None)
+            if profile_id is not None:
+                if (run["query"], profile_id) in exported:
+                    continue
+                exported.add((run["query"], profile_id))
+            sheet.append([HistoryExporter.cell(candidate.get(column)) for column in columns])
+            rows += 1
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue(), rows
+
+    def export(self, date_key):
+        runs = self.db.fetch_runs(date_key)
+        if not runs:
+            logger.info(f"No data found for {date_key}")
+            return []
+        files = []
+        # a person found on both sites is exported once per query, in the first file
+        exported = set()
+        for run in runs:
+            with Metrics.timer("export", resource=run["resource"]):
+                content, rows = self.workbook(run, exported)
+            filename = f"{run['resource']}_{date_key.replace('.', '')}_{run['query'].replace(' ', '_')}.xlsx"
+            logger.info(f"Exported {rows} candidates of query '{run['query']}' to {filename}")
+            files.append((filename, content))
+
+        if len(files) <= HistoryExporter.zip_after:
+            return files
+        buffer = io.BytesIO()
+        # xlsx files are zip archives already, compressing them again gains nothing
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            for filename, content in files:
+                archive.writestr(filename, content)
+        return [(f"history_{date_key.replace('.', '')}.zip", buffer.getvalue())]
+
+
+def export_parsing_history(date_key):
+    """Excel files of the date as [(filename, bytes)], nothing is written to the working directory"""
+    with DataBaseManager() as db:
+        return HistoryExporter(db).export(date_key)
 
 
 if __name__ == "__main__":
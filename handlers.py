@@ -1,8 +1,9 @@
 import enum
 import logging
 import asyncio
+import math
 from aiogram import types, Dispatcher, F, Router
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
 from datetime import datetime
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command, CommandStart
@@ -14,10 +15,12 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton
 )
-import os
 from states import *
 from database_manager import *
 from parsers import *
+from scheduler import ParseScheduler
+from metrics import Metrics
+from config import ADMIN_IDS, INCREMENTAL_CRAWL, RABOTA_UA_EXTRACTION_MODE
 
 router = Router()
 
@@ -90,6 +93,139 @@ def get_keyboards(keyboard_id):
         return pre_run()
 
 
+def today():
+    return datetime.now().strftime("%d.%m.%Y")
+
+
+class CandidatesPipeline:
+    """Scores candidates as a parser yields them and stores them in batches of batch_size
+
+    Every crawl is recorded as a run, a crawl that got through the whole query drops earlier runs of it that day,
+    so a re-run replaces the previous result. A cancelled or crashed crawl keeps every batch stored before it
+    stopped as a partial run and never replaces a complete one
+    """
+    batch_size = 50
+
+    def __init__(self, resource_name, query, count_mark, batch_size=None, cancelled=None, resume_id=None):
+        self.resource_name = resource_name
+        self.query = query
+        self.count_mark = count_mark
+        self.resume_id = resume_id
+        self.batch_size = batch_size or CandidatesPipeline.batch_size
+        self.cancelled = cancelled
+        self.date_key = today()
+        self.run = None
+        self.batch = []
+        self.seen = []
+        self.stored = 0
+
+    def start(self):
+        with DataBaseManager() as db:
+            self.run = db.start_run(date_key=self.date_key, resource_name=self.resource_name, query=self.query)
+
+    async def start_async(self):
+        async with AsyncDataBaseManager() as db:
+            self.run = await db.start_run(date_key=self.date_key, resource_name=self.resource_name, query=self.query)
+
+    def queue(self, candidate):
+        """Scores and queues the candidate, a reference to an already stored resume is queued as it is,
+        returns True when the batch is full"""
+        if candidate.get("seen"):
+            self.seen.append(candidate["link"])
+        else:
+            self.batch.append(self.score(candidate))
+        return len(self.batch) + len(self.seen) >= self.batch_size
+
+    def add(self, candidate):
+        if self.queue(candidate):
+            self.flush()
+
+    def score(self, candidate):
+        with Metrics.timer("score", resource=self.resource_name):
+            candidate["mark"] = self.count_mark(candidate)
+        Metrics.inc("candidates_total", resource=self.resource_name)
+        return candidate
+
+    def flush(self):
+        if not self.batch and not self.seen:
+            return
+        with DataBaseManager() as db:
+            if self.seen:
+                self.take_stored(db.fetch_stored_candidates(self.resource_name, self.seen, self.resume_id))
+            db.store_candidates(self.run, self.batch, self.resume_id)
+        self.batch_stored()
+
+    async def flush_async(self):
+        if not self.batch and not self.seen:
+            return
+        async with AsyncDataBaseManager() as db:
+            if self.seen:
+                self.take_stored(await db.fetch_stored_candidates(self.resource_name, self.seen, self.resume_id))
+            await db.store_candidates(self.run, self.batch, self.resume_id)
+        self.batch_stored()
+
+    def take_stored(self, stored):
+        """Queues the stored versions of the seen resumes"""
+        if len(stored) < len(self.seen):
+            logging.warning(f"{len(self.seen) - len(stored)} skipped {self.resource_name} resumes "
+                            f"aren't stored, left out of the run")
+        self.batch.extend(self.score(candidate) for candidate in stored.values())
+        self.seen = []
+
+    def batch_stored(self):
+        self.stored += len(self.batch)
+        logging.info(f"Stored {self.stored} {self.resource_name} candidates for query '{self.query}'")
+        self.batch = []
+
+    def finish(self, status):
+        with DataBaseManager() as db:
+            db.finish_run(self.run["_id"], status)
+
+    async def finish_async(self, status):
+        async with AsyncDataBaseManager() as db:
+            await db.finish_run(self.run["_id"], status)
+
+    def is_cancelled(self):
+        if self.cancelled and self.cancelled.is_set():
+            logging.info(f"Parsing of {self.resource_name} for query '{self.query}' cancelled")
+            return True
+        return False
+
+    def consume(self, candidates):
+        self.start()
+        status = "failed"
+        try:
+            for candidate in candidates:
+                if self.is_cancelled():
+                    status = "cancelled"
+                    break
+                self.add(candidate)
+            else:
+                status = "done"
+        finally:
+            self.flush()
+            self.finish(status)
+        return self.stored
+
+    async def consume_async(self, candidates):
+        """consume for async iterators, runs are written through AsyncDataBaseManager on the running loop"""
+        await self.start_async()
+        status = "failed"
+        try:
+            async for candidate in candidates:
+                if self.is_cancelled():
+                    status = "cancelled"
+                    break
+                if self.queue(candidate):
+                    await self.flush_async()
+            else:
+                status = "done"
+        finally:
+            await self.flush_async()
+            await self.finish_async(status)
+        return self.stored
+
+
 def create_dates_inline_keyboard(dates):
     buttons = [
         [InlineKeyboardButton(text=date, callback_data=f"date_{date}") for date in dates]
@@ -101,8 +237,8 @@ def create_dates_inline_keyboard(dates):
 async def check_history(msg: types.Message, state: FSMContext):
     await msg.answer(text="Choose date to fetch history")
 
-    with DataBaseManager() as db:
-        dates = db.fetch_all_ids()
+    async with AsyncDataBaseManager() as db:
+        dates = await db.fetch_dates()
 
     inline_kb = create_dates_inline_keyboard(dates)
     await msg.answer("Select a date to view parsing history:", reply_markup=inline_kb)
@@ -113,24 +249,55 @@ async def fetch_and_send_history(callback_query: types.CallbackQuery, state: FSM
     date_key = callback_query.data.split("_")[1]
     user_id = callback_query.from_user.id
 
-    with DataBaseManager() as db:
-        document = db.fetch_data(date_key)
+    async with AsyncDataBaseManager() as db:
+        runs = await db.fetch_runs(date_key)
 
-    if not document:
+    if not runs:
         await callback_query.message.answer(f"No data found for {date_key}")
         return
 
-    filenames = save_parsing_history_to_excel(date_key)
-    for filename in filenames:
-        file = FSInputFile(filename)
-        await callback_query.message.answer_document(file)
-        os.remove(filename)
+    files = await asyncio.to_thread(export_parsing_history, date_key)
+    for filename, content in files:
+        await callback_query.message.answer_document(BufferedInputFile(content, filename=filename))
     await callback_query.answer()
 
 
+@router.message(Command("queue"))
+async def show_queue_position(msg: types.Message, scheduler: ParseScheduler):
+    job = await scheduler.user_job(msg.from_user.id)
+    if not job:
+        await msg.answer(text="You have no parsing jobs")
+        return
+    position, eta = await scheduler.position(job)
+    if position == 0:
+        await msg.answer(text=f"Your parsing is running, it should end in ~{math.ceil(eta / 60)} min")
+    else:
+        await msg.answer(text=f"Your parsing is {position} in queue, it should end in ~{math.ceil(eta / 60)} min")
+
+
+@router.message(Command("cancel"))
+async def cancel_parsing(msg: types.Message, state: FSMContext, scheduler: ParseScheduler):
+    cancelled = await scheduler.cancel(msg.from_user.id)
+    if not cancelled:
+        await msg.answer(text="You have no parsing jobs")
+        return
+    if not await scheduler.user_job(msg.from_user.id):
+        await state.clear()
+    await msg.answer(text="Parsing cancelled", reply_markup=get_keyboards(KeyBoards.MAIN_MENU))
+
+
+@router.message(Command("stats"))
+async def show_stats(msg: types.Message):
+    if msg.from_user.id not in ADMIN_IDS:
+        return
+    ok, result = await AsyncDataBaseManager.health_check()
+    mongo = f"MongoDB: ok, ping {result:.1f} ms" if ok else f"MongoDB: unavailable, {result}"
+    await msg.answer(text=f"{Metrics.summary()}\n{mongo}")
+
+
 @router.message(ActionBlocker.parsing_inbound)
 async def block_action(msg: types.Message, state: FSMContext):
-    await msg.answer(text="Wait until parsing will end")
+    await msg.answer(text="Wait until parsing will end\n/queue - show queue position\n/cancel - cancel parsing")
 
 
 @router.message(Command("start"))
@@ -264,7 +431,7 @@ async def get_resource(msg: types.Message, state: FSMContext):
 
 @router.message(F.text == "Run Script")
 @router.message(Switchers.run_script)
-async def parse_data(msg: types.Message, state: FSMContext):
+async def parse_data(msg: types.Message, state: FSMContext, scheduler: ParseScheduler):
     def prepare_data(d):
         langs_table = {
             "English": "eng", "Ukrainian": "ua", "russian": "ru", "Poland": "pol",
@@ -313,52 +480,78 @@ async def parse_data(msg: types.Message, state: FSMContext):
         else:
             return None, prepare_rabota_ua()
 
-    def parse_work_ua(q):
-        parser = WorkuaParser()
-        result = parser.run_script(q)
-        with MarksManager() as m:
-            for d in result:
-                d["mark"] = m.count_mark_workua(d)
-        result.sort(key=lambda x: x["mark"], reverse=True)
-        with DataBaseManager() as db:
-            db.append_data(
-                date_key=datetime.now().strftime("%d.%m.%Y"),
-                query=" ".join(q.get("position", "ALL")),
-                resource_name="WORK_UA",
-                data=result
-            )
-
-    async def parse_rabota_ua(q):
-        parser = RabotaUa()
-        result = await asyncio.to_thread(parser.run_script, q)
-
-        with MarksManager() as m:
-            for d in result:
-                d["mark"] = m.count_mark_rabotaua(d)
-        result.sort(key=lambda x: x["mark"], reverse=True)
-        with DataBaseManager() as db:
-            db.append_data(
-                date_key=datetime.now().strftime("%d.%m.%Y"),
-                query=" ".join(q.get("position", "ALL")),
-                resource_name="RABOTA_UA",
-                data=result
-            )
-
     user_query = await state.get_data()
-    resource = user_query.get("resource")
     await state.clear()
     await state.set_state(ActionBlocker.parsing_inbound)
     work_ua_query, rabota_ua_query = prepare_data(user_query)
     print(work_ua_query, rabota_ua_query)
-    await msg.answer(text="Wait till parsing ends", reply_markup=ReplyKeyboardRemove())
 
-    if resource == "WorkUA":
-        parse_work_ua(work_ua_query)
-    elif resource == "RabotaUA":
-        await parse_rabota_ua(rabota_ua_query)
-    elif resource == "Both":
-        parse_work_ua(work_ua_query)
-        await parse_rabota_ua(rabota_ua_query)
+    try:
+        job = await scheduler.submit(msg.from_user.id, msg.chat.id, work_ua_query, rabota_ua_query)
+    except Exception as e:
+        # the chat was blocked before submitting so a fast job can't release it first, unblock it on failure
+        logging.error(f"Submitting parsing job of user {msg.from_user.id} failed: {e}")
+        await state.clear()
+        await msg.answer(text="Could not queue parsing, try again later", reply_markup=ReplyKeyboardRemove())
+        return
+    position, eta = await scheduler.position(job)
+    await msg.answer(
+        text=f"Your parsing is {position} in queue, it should end in ~{math.ceil(eta / 60)} min\n"
+             f"/queue - show queue position\n/cancel - cancel parsing",
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+
+def load_seen(resource_name, id_getter):
+    """SeenIndex of the resource when INCREMENTAL_CRAWL is on, None makes the parser fetch every resume"""
+    if not INCREMENTAL_CRAWL:
+        return None
+    with DataBaseManager() as db:
+        return SeenIndex.load(db, resource_name, id_getter, exclude_date_keys=(today(),))
+
+
+async def parse_work_ua(q, cancelled=None):
+    """Runs on the bot event loop, only loading the seen index goes to a worker thread"""
+    parser = WorkuaParser()
+    seen = await asyncio.to_thread(load_seen, "WORK_UA", WorkuaParser.resume_id)
+    with MarksManager() as m:
+        pipeline = CandidatesPipeline(
+            "WORK_UA", " ".join(q.get("position", "ALL")), m.count_mark_workua, cancelled=cancelled,
+            resume_id=WorkuaParser.resume_id
+        )
+        return await pipeline.consume_async(parser.run_script_async(q, seen=seen))
+
+
+def parse_rabota_ua(q, cancelled=None):
+    """Runs in a worker thread, Playwright sync API can't run on the bot event loop"""
+    parser = RabotaUa(extraction_mode=RABOTA_UA_EXTRACTION_MODE)
+    seen = load_seen("RABOTA_UA", RabotaUa.resume_id)
+    with MarksManager() as m:
+        pipeline = CandidatesPipeline(
+            "RABOTA_UA", " ".join(q.get("position", "ALL")), m.count_mark_rabotaua, cancelled=cancelled,
+            resume_id=RabotaUa.resume_id
+        )
+        return pipeline.consume(parser.run_script(q, seen))
+
+
+async def run_parsing_job(job, cancelled):
+    """ParseScheduler runner, crawls the chosen resources concurrently and returns the report
+
+    work.ua is crawled on the event loop, robota.ua in a worker thread as its crawl drives the sync browser pool
+    """
+    jobs = {}
+    if job.get("work_ua_query") is not None:
+        jobs["WorkUA"] = parse_work_ua(job["work_ua_query"], cancelled)
+    if job.get("rabota_ua_query") is not None:
+        jobs["RabotaUA"] = asyncio.to_thread(parse_rabota_ua, job["rabota_ua_query"], cancelled)
+
+    report = []
+    for name, result in zip(jobs, await asyncio.gather(*jobs.values(), return_exceptions=True)):
+        if isinstance(result, Exception):
+            logging.error(f"Parsing {name} failed: {result}")
+            report.append(f"{name}: failed")
+        else:
+            report.append(f"{name}: {result} candidates")
 
-    await msg.answer(text="Parsing ended", reply_markup=get_keyboards(KeyBoards.MAIN_MENU))
+    return "Parsing ended\n" + "\n".join(report)
 
@@ -2,9 +2,14 @@ import asyncio
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
-from handlers import router
+from handlers import router, run_parsing_job, get_keyboards, KeyBoards
+from scheduler import ParseScheduler
+from metrics import MetricsServer
+from database_manager import DataBaseManager, AsyncDataBaseManager
+from parsers import RequestsManager
+from response_cache import ResponseCache
 
-from config import API_KEY
+from config import API_KEY, METRICS_HOST, METRICS_PORT, RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB
 
 logging.basicConfig(level=logging.INFO)
 
@@ -12,9 +17,37 @@ logging.basicConfig(level=logging.INFO)
 async def main():
     bot = Bot(token=API_KEY)
     dp = Dispatcher(storage=MemoryStorage())
+    if RESPONSE_CACHE_DIR:
+        RequestsManager.cache = ResponseCache(RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+        logging.info(f"Response cache is on, directory {RESPONSE_CACHE_DIR}")
+
+    scheduler = ParseScheduler(bot, dp.storage, run_parsing_job, done_keyboard=get_keyboards(KeyBoards.MAIN_MENU))
+    dp["scheduler"] = scheduler
+
+    # jobs are dispatched only once MongoDB answers, the scheduler retries on its own if it goes away later
+    ok, result = await AsyncDataBaseManager.health_check()
+    while not ok:
+        logging.warning(f"Waiting for MongoDB, retrying in {ParseScheduler.retry_delay} s")
+        await asyncio.sleep(ParseScheduler.retry_delay)
+        ok, result = await AsyncDataBaseManager.health_check()
+    logging.info(f"MongoDB is available, ping {result:.1f} ms")
+    async with AsyncDataBaseManager() as db:
+        await db.ensure_indexes()
+    scheduler_task = asyncio.create_task(scheduler.run())
+
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    if metrics_server:
+        await metrics_server.start()
 
     dp.include_router(router)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        scheduler_task.cancel()
+        if metrics_server:
+            await metrics_server.stop()
+        AsyncDataBaseManager.close_clients()
+        DataBaseManager.close_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
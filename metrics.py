@@ -0,0 +1,197 @@
+from aiohttp import web
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import bisect
+import threading
+import time
+
+
+class Metrics:
+    """Process wide counters and stage timings of crawls
+
+    Stages are fetch, render, parse, score, persist and export. Values are kept per label set and rendered in
+    Prometheus text format by render(), summary() is the short text of the /stats bot command
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    prefix = "parser_bot"
+
+    descriptions = {
+        "stage_seconds": ("histogram", "Time spent per page or batch in a crawl stage"),
+        "bytes_downloaded_total": ("counter", "Bytes of page bodies downloaded"),
+        "http_responses_total": ("counter", "HTTP responses by host and status"),
+        "retries_total": ("counter", "Retried HTTP requests by host and status or error"),
+        "failures_total": ("counter", "Failures by stage and type"),
+        "candidates_total": ("counter", "Candidates scored by resource"),
+    }
+
+    _lock = threading.Lock()
+    _counters = {}
+    # (name, labels) -> [bucket counts..., +Inf count, sum]
+    _histograms = {}
+
+    @staticmethod
+    def host(url):
+        return urlsplit(url).netloc or "unknown"
+
+    @staticmethod
+    def __key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def inc(name, amount=1, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + amount
+
+    @staticmethod
+    def observe(stage, seconds, **labels):
+        key = Metrics.__key("stage_seconds", dict(labels, stage=stage))
+        with Metrics._lock:
+            histogram = Metrics._histograms.get(key)
+            if histogram is None:
+                histogram = Metrics._histograms[key] = [0] * (len(Metrics.buckets) + 2)
+            histogram[bisect.bisect_left(Metrics.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    @staticmethod
+    @contextmanager
+    def timer(stage, **labels):
+        """Observes the time of the block, a raised exception is also counted as a failure of the stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            Metrics.failure(stage, type(e).__name__)
+            raise
+        finally:
+            Metrics.observe(stage, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def failure(stage, reason):
+        Metrics.inc("failures_total", stage=stage, reason=reason)
+
+    @staticmethod
+    def response(url, status, body_size=0):
+        host = Metrics.host(url)
+        Metrics.inc("http_responses_total", host=host, status=status)
+        if body_size:
+            Metrics.inc("bytes_downloaded_total", body_size, host=host)
+
+    @staticmethod
+    def retry(url, reason):
+        Metrics.inc("retries_total", host=Metrics.host(url), reason=reason)
+
+    @staticmethod
+    def reset():
+        with Metrics._lock:
+            Metrics._counters.clear()
+            Metrics._histograms.clear()
+
+    @staticmethod
+    def __labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    @staticmethod
+    def render():
+        with Metrics._lock:
+            counters = dict(Metrics._counters)
+            histograms = {k: list(v) for k, v in Metrics._histograms.items()}
+
+        lines = []
+        for name, (metric_type, description) in Metrics.descriptions.items():
+            full_name = f"{Metrics.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            if metric_type == "counter":
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{full_name}{Metrics.__labels(labels)} {value}")
+                continue
+            for (key_name, labels), histogram in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(Metrics.buckets + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{Metrics.__labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{full_name}_sum{Metrics.__labels(labels)} {histogram[-1]}")
+                lines.append(f"{full_name}_count{Metrics.__labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def summary():
+        """Totals per stage and per host for the bot /stats command"""
+        with Metrics._lock:
+            counters = dict(Metrics._counters)
+            histograms = {k: list(v) for k, v in Metrics._histograms.items()}
+
+        stages = {}
+        for (_, labels), histogram in histograms.items():
+            stage = dict(labels)["stage"]
+            count, total = stages.get(stage, (0, 0.0))
+            stages[stage] = (count + sum(histogram[:-1]), total + histogram[-1])
+
+        def totals(name, label):
+            result = {}
+            for (key_name, labels), value in counters.items():
+                if key_name == name:
+                    key = dict(labels).get(label, "")
+                    result[key] = result.get(key, 0) + value
+            return result
+
+        lines = ["Stages:"]
+        for stage in ("fetch", "render", "parse", "score", "persist", "export"):
+            count, total = stages.get(stage, (0, 0.0))
+            average = f"{total / count * 1000:.1f} ms avg" if count else "-"
+            lines.append(f"  {stage}: {count} done, {total:.1f} s total, {average}")
+
+        downloaded = totals("bytes_downloaded_total", "host")
+        lines.append(f"Downloaded: {sum(downloaded.values()) / 1024 / 1024:.1f} MB")
+        responses = {}
+        for (key_name, labels), value in counters.items():
+            if key_name == "http_responses_total":
+                labels = dict(labels)
+                responses.setdefault(labels["host"], {})[labels["status"]] = value
+        for host, statuses in sorted(responses.items()):
+            lines.append(f"  {host}: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+
+        retries = totals("retries_total", "reason")
+        lines.append("Retries: " + (", ".join(f"{k}: {v}" for k, v in sorted(retries.items())) or "0"))
+        failures = {}
+        for (key_name, labels), value in counters.items():
+            if key_name == "failures_total":
+                labels = dict(labels)
+                key = f"{labels['stage']}/{labels['reason']}"
+                failures[key] = failures.get(key, 0) + value
+        lines.append("Failures: " + (", ".join(f"{k}: {v}" for k, v in sorted(failures.items())) or "0"))
+        candidates = totals("candidates_total", "resource")
+        lines.append("Candidates: " + (", ".join(f"{k}: {v}" for k, v in sorted(candidates.items())) or "0"))
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves Metrics.render() on http://host:port/metrics from the running event loop"""
+
+    def __init__(self, host="127.0.0.1", port=9108):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.__metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    @staticmethod
+    async def __metrics(request):
+        return web.Response(text=Metrics.render(), content_type="text/plain", charset="utf-8")
@@ -0,0 +1,103 @@
+"""Moves parsing history from the one document per date layout to the candidates and runs collections
+
+Every legacy document {"_id": date_key, resource: {query: [candidates]}} becomes one run per query, candidates
+are merged into profiles and referred to by one entry per candidate. Documents are read one at a time from the
+oldest date on, so profiles end up with the latest version of every resume. Queries already having a run on
+that date are skipped, so an interrupted migration can be run again. Indexes are created before anything is copied
+
+>> python migrate_history.py --dry-run
+>> python migrate_history.py --batch-size 500 --drop-legacy
+"""
+import argparse
+import logging
+import sys
+
+from database_manager import DataBaseManager
+from parsers import RabotaUa, WorkuaParser
+
+logger = logging.getLogger(__name__)
+resume_ids = {"WORK_UA": WorkuaParser.resume_id, "RABOTA_UA": RabotaUa.resume_id}
+
+
+def legacy_queries(document):
+    for resource_name, queries in document.items():
+        if resource_name == "_id" or not isinstance(queries, dict):
+            continue
+        for query, candidates in queries.items():
+            yield resource_name, query, candidates or []
+
+
+def dated_ids(ids):
+    """Legacy document ids in chronological order, ids that aren't dd.mm.yyyy dates are skipped"""
+    dates = []
+    for date_key in ids:
+        try:
+            DataBaseManager.date_of(date_key)
+        except (TypeError, ValueError):
+            logger.warning(f"Skipped document {date_key!r}, its id is not a dd.mm.yyyy date")
+            continue
+        dates.append(date_key)
+    return DataBaseManager.sorted_dates(dates)
+
+
+def migrate_document(db, document, dry_run=False):
+    """Copies one legacy document, returns (runs created, candidates copied)"""
+    date_key = document["_id"]
+    runs = copied = 0
+    for resource_name, query, candidates in legacy_queries(document):
+        key = {"date_key": date_key, "resource": resource_name, "query": query, "status": {"$ne": "migrating"}}
+        if db.runs.count_documents(key, limit=1):
+            logger.info(f"{date_key} {resource_name} '{query}' already migrated, skipped")
+            continue
+        runs += 1
+        copied += len(candidates)
+        if dry_run:
+            continue
+        # candidates of a migration interrupted in the middle of this query
+        db.drop_runs([run["_id"] for run in db.runs.find(dict(key, status="migrating"), {"_id": 1})])
+        run = db.start_run(date_key, resource_name, query, status="migrating")
+        db.store_candidates(run, candidates, resume_ids.get(resource_name))
+        db.finish_run(run["_id"], status="migrated")
+    return runs, copied
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--conn-url", default="mongodb://localhost:27017")
+    arg_parser.add_argument("--db-name", default="parsed_resumes")
+    arg_parser.add_argument("--legacy-collection", default="parsing_results")
+    arg_parser.add_argument("--batch-size", type=int, default=1000, help="candidates per bulk write")
+    arg_parser.add_argument("--dry-run", action="store_true", help="only count what would be copied")
+    arg_parser.add_argument("--drop-legacy", action="store_true", help="drop the legacy collection when done")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    DataBaseManager.configure(write_batch_size=args.batch_size)
+    ok, result = DataBaseManager.health_check(args.conn_url)
+    if not ok:
+        return 1
+
+    total_runs = total_candidates = 0
+    with DataBaseManager(args.conn_url, args.db_name, args.legacy_collection) as db:
+        if not args.dry_run:
+            db.ensure_indexes()
+        for date_key in dated_ids(db.fetch_all_ids()):
+            document = db.fetch_data(date_key)
+            if not document:
+                continue
+            runs, copied = migrate_document(db, document, args.dry_run)
+            total_runs += runs
+            total_candidates += copied
+            logger.info(f"{date_key}: {runs} runs, {copied} candidates")
+
+        action = "Would copy" if args.dry_run else "Copied"
+        print(f"{action} {total_candidates} candidates of {total_runs} runs")
+        if args.drop_legacy and not args.dry_run:
+            db.collection.drop()
+            print(f"Dropped {args.legacy_collection}")
+    DataBaseManager.close_clients()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,71 +1,662 @@
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
 from fake_useragent import UserAgent
 import requests
+import aiohttp
+import asyncio
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 import logging
 import re
 import threading
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from response_cache import ResponseCache
+from metrics import Metrics
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class CappedRetry(Retry):
+    """urllib3 Retry that waits at most RequestsManager.max_retry_after seconds for a Retry-After header"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, RequestsManager.max_retry_after)
+
+
 class RequestsManager:
     ua = UserAgent()
 
+    # Shared HTTP session settings, one keep-alive session per host
+    pool_size = 20
+    max_retries = 3
+    backoff_factor = 0.5
+    retry_statuses = (429, 500, 502, 503, 504)
+    timeout = (5, 30)
+    # longest Retry-After waited for by the sync and async fetchers, longer ones are cut down to it
+    max_retry_after = 30
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    # On-disk cache below every fetcher, None goes to the network every time, main sets it from config
+    cache = None
+
+    @staticmethod
+    def configure(pool_size=None, max_retries=None, backoff_factor=None, timeout=None, max_retry_after=None):
+        """Change session settings, already opened sessions are recreated on next request"""
+        if pool_size is not None:
+            RequestsManager.pool_size = pool_size
+        if max_retries is not None:
+            RequestsManager.max_retries = max_retries
+        if backoff_factor is not None:
+            RequestsManager.backoff_factor = backoff_factor
+        if timeout is not None:
+            RequestsManager.timeout = timeout
+        if max_retry_after is not None:
+            RequestsManager.max_retry_after = max_retry_after
+        RequestsManager.close_sessions()
+
     @staticmethod
-    def make_request(url, method="GET"):
+    def get_session(url):
+        host = urlsplit(url).netloc
+        with RequestsManager._sessions_lock:
+            session = RequestsManager._sessions.get(host)
+            if session is None:
+                retry = CappedRetry(
+                    total=RequestsManager.max_retries,
+                    backoff_factor=RequestsManager.backoff_factor,
+                    status_forcelist=RequestsManager.retry_statuses,
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=RequestsManager.pool_size,
+                    max_retries=retry,
+                    pool_block=True
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"connection": "keep-alive"})
+                RequestsManager._sessions[host] = session
+        return session
+
+    @staticmethod
+    def close_sessions():
+        with RequestsManager._sessions_lock:
+            for session in RequestsManager._sessions.values():
+                session.close()
+            RequestsManager._sessions.clear()
+
+    @staticmethod
+    def make_request(url, method="GET", page_type=None):
+        cache = RequestsManager.cache if method == "GET" else None
+        entry = cache.get(url) if cache else None
+        if entry and cache.is_fresh(entry, url, page_type):
+            cache.count("hits")
+            return entry["body"]
+        if cache:
+            cache.count("misses")
+
         try:
-            proxies = {"https": "socks5://127.0.0.1:9050"}
-            response = requests.request(method=method, url=url, headers={"user-agent":RequestsManager.ua.random}, proxies={})
+            session = RequestsManager.get_session(url)
+            headers = {"user-agent": RequestsManager.ua.random}
+            if entry:
+                headers.update(ResponseCache.revalidation_headers(entry))
+            with Metrics.timer("fetch", page_type=page_type or "other"):
+                response = session.request(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    timeout=RequestsManager.timeout
+                )
+            RequestsManager.record_response(url, response)
+            if response.status_code == 304 and entry:
+                cache.refresh(url, entry)
+                return entry["body"]
             if response.status_code != 200:
+                logger.warning(f"Request to {url} returned status {response.status_code}")
+                Metrics.failure("fetch", f"status_{response.status_code}")
                 return None
             response.encoding = response.apparent_encoding
+            if cache:
+                cache.put(url, response.text, headers=response.headers)
             return response.text
         except requests.RequestException as e:
             logger.error(f"Something went wrong while requesting to {url}\nError: {e}")
 
     @staticmethod
-    def get_html_playwright(link, selector_specified=None):
-        page_content = None
-        try:
-            with sync_playwright() as p:
-                browser = p.chromium.launch(headless=True)
-                context = browser.new_context(user_agent=RequestsManager.ua.random)
-                page = context.new_page()
-                page.goto(link)
-                page.wait_for_load_state('networkidle')
-                # page.wait_for_selector('div.santa-flex.santa-items-baseline.santa-space-x-10.ng-star-inserted')
-                if selector_specified:
-                    page.wait_for_selector(selector_specified)
-                page_content = page.content()
-                browser.close()
-        except Exception as e:
-            logger.error(f"Failed to retrieve page content: {e}")
+    def record_response(url, response):
+        """Counts the response and the retries urllib3 made before it"""
+        retries = getattr(response.raw, "retries", None)
+        for attempt in getattr(retries, "history", ()):
+            if attempt.status:
+                Metrics.response(url, attempt.status)
+            Metrics.retry(url, str(attempt.status) if attempt.status else type(attempt.error).__name__)
+        Metrics.response(url, response.status_code, len(response.content))
+
+    # Fetch path that returned the content last time per page type, "http" unless the browser was needed
+    _strategies = {}
+    _strategies_lock = threading.Lock()
+
+    @staticmethod
+    def page_pattern(url):
+        parts = urlsplit(url)
+        return parts.netloc + re.sub(r"\d+", "{id}", parts.path)
+
+    @staticmethod
+    def get_strategy(page_type):
+        with RequestsManager._strategies_lock:
+            return RequestsManager._strategies.get(page_type, "http")
+
+    @staticmethod
+    def remember_strategy(page_type, strategy):
+        with RequestsManager._strategies_lock:
+            if RequestsManager._strategies.get(page_type) != strategy:
+                logger.info(f"Pages of type {page_type} will be fetched with {strategy}")
+            RequestsManager._strategies[page_type] = strategy
+
+    @staticmethod
+    def fetch_http(url, content_check, page_type=None):
+        """HTTP half of fetch for threads that must not touch the browser, returns (page_text, needs_browser)
+
+        needs_browser is set when pages of page_type are fetched with the browser (no request is made then)
+        or the HTTP answer lacks the content content_check looks for. A failed HTTP request (None) doesn't need it
+        """
+        page_type = page_type or RequestsManager.page_pattern(url)
+        if RequestsManager.get_strategy(page_type) == "browser":
+            return None, True
+        page_text = RequestsManager.make_request(url, page_type=page_type)
+        if page_text is None or content_check(page_text):
+            return page_text, False
+        return page_text, True
+
+    @staticmethod
+    def render_missing(urls, fetched, content_check, page_type, pool, profile=None):
+        """Browser half of fetch, renders the urls whose fetch_http result needs the browser and returns page texts
+
+        Must run on the thread that owns pool. When every page of the batch needed the browser and it
+        delivered the content, later pages of page_type skip plain HTTP
+        """
+        texts = [page_text for page_text, _ in fetched]
+        missing = [i for i, (_, needs_browser) in enumerate(fetched) if needs_browser]
+        if not missing:
+            return texts
+        logger.info(f"{len(missing)} of {len(urls)} pages of type {page_type} need the browser, rendering them")
+        rendered = list(pool.fetch_many([urls[i] for i in missing], profile or FULL_RENDER))
+        for i, page_text in zip(missing, rendered):
+            texts[i] = page_text
+        if len(missing) == len(urls) and any(t and content_check(t) for t in rendered):
+            RequestsManager.remember_strategy(page_type, "browser")
+        return texts
+
+    @staticmethod
+    def fetch(url, content_check, page_type=None, pool=None, profile=None):
+        """Plain HTTP first, the browser only when the HTTP answer lacks the content content_check looks for
 
-        return page_content
+        Without pool the page is never rendered and the HTTP answer is returned whatever it holds
+        """
+        page_type = page_type or RequestsManager.page_pattern(url)
+        if pool is None:
+            return RequestsManager.make_request(url, page_type=page_type)
+        fetched = RequestsManager.fetch_http(url, content_check, page_type)
+        return RequestsManager.render_missing([url], [fetched], content_check, page_type, pool, profile)[0]
 
     @staticmethod
-    def iterate_links(links_list):
+    def fetch_many(urls, content_check, page_type, pool, profile=None):
+        """fetch for a batch of urls, HTTP requests go concurrently and only pages lacking content go to the pool"""
+        with BoundedExecutor() as executor:
+            fetched = executor.map(lambda url: RequestsManager.fetch_http(url, content_check, page_type), urls)
+        fetched = [result or (None, False) for result in fetched]
+        return RequestsManager.render_missing(urls, fetched, content_check, page_type, pool, profile)
+
+
+class BoundedExecutor:
+    """Thread pool stage for url-bound jobs
+
+    At most queue_size jobs are queued or running at once (submit blocks when the queue is full),
+    at most max_per_host of them hit the same host, results of map come back in input order and
+    a failing job is logged and turned into None instead of breaking the whole stage
+    """
+    max_workers = 16
+    max_per_host = 8
+    queue_size = 64
+
+    def __init__(self, max_workers=None, max_per_host=None, queue_size=None):
+        self.max_per_host = max_per_host or BoundedExecutor.max_per_host
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or BoundedExecutor.max_workers)
+        self.queue_slots = threading.BoundedSemaphore(queue_size or BoundedExecutor.queue_size)
+        self.host_limits = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+
+    def __host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.Semaphore(self.max_per_host)
+            return self.host_limits[host]
+
+    def __run(self, func, url):
         try:
-            with sync_playwright() as p:
-                browser = p.chromium.launch(headless=True)
-                context = browser.new_context(user_agent=RequestsManager.ua.random)
-                page = context.new_page()
-                for link in links_list:
-                    page.goto(link)
-                    page.wait_for_load_state('networkidle')
-                    page.wait_for_selector("div.main-content-wrapper", timeout=50000)
-                    yield page.content()
-                browser.close()
+            with self.__host_limit(url):
+                return func(url)
         except Exception as e:
-            logger.error(f"Failed to iterate over links: {e}")
+            logger.error(f"Job for {url} failed: {e}")
+            return None
+        finally:
+            self.queue_slots.release()
+
+    def submit(self, func, url):
+        self.queue_slots.acquire()
+        return self.executor.submit(self.__run, func, url)
+
+    def map(self, func, urls):
+        futures = [self.submit(func, url) for url in urls]
+        return [future.result() for future in futures]
+
+
+class AsyncRequestsManager:
+    """aiohttp counterpart of RequestsManager, one session shared by the whole crawl
+
+    concurrency caps requests in flight for the crawl, limit_per_host caps open connections per site
+    """
+    concurrency = 50
+    limit_per_host = 20
+
+    def __init__(self, concurrency=None, limit_per_host=None):
+        self.concurrency = concurrency or AsyncRequestsManager.concurrency
+        self.limit_per_host = limit_per_host or AsyncRequestsManager.limit_per_host
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.limit_per_host)
+        connect_timeout, read_timeout = RequestsManager.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def fetch_http(self, url, content_check, page_type):
+        """Async counterpart of RequestsManager.fetch_http, returns (page_text, needs_browser)"""
+        if RequestsManager.get_strategy(page_type) == "browser":
+            return None, True
+        page_text = await self.make_request(url, page_type=page_type)
+        if page_text is None or content_check(page_text):
+            return page_text, False
+        return page_text, True
+
+    async def make_request(self, url, method="GET", page_type=None):
+        cache = RequestsManager.cache if method == "GET" else None
+        entry = cache.get(url) if cache else None
+        if entry and cache.is_fresh(entry, url, page_type):
+            cache.count("hits")
+            return entry["body"]
+        if cache:
+            cache.count("misses")
+
+        headers = {"user-agent": RequestsManager.ua.random}
+        if entry:
+            headers.update(ResponseCache.revalidation_headers(entry))
+        for attempt in range(RequestsManager.max_retries + 1):
+            async with self.semaphore:
+                started = time.perf_counter()
+                try:
+                    page_text, delay = await self.__request(url, method, headers, entry, cache, attempt)
+                finally:
+                    Metrics.observe("fetch", time.perf_counter() - started, page_type=page_type or "other")
+            if delay is None:
+                return page_text
+            # the slot is given back while waiting, a throttled host doesn't hold up requests to others
+            await asyncio.sleep(delay)
+
+    async def __request(self, url, method, headers, entry, cache, attempt):
+        """One attempt, returns (page text, None) or (None, seconds to wait before the next attempt)"""
+        last_attempt = attempt == RequestsManager.max_retries
+        try:
+            async with self.session.request(method, url, headers=headers) as response:
+                if response.status == 304 and entry:
+                    Metrics.response(url, response.status)
+                    cache.refresh(url, entry)
+                    return entry["body"], None
+                if response.status in RequestsManager.retry_statuses and not last_attempt:
+                    Metrics.response(url, response.status)
+                    Metrics.retry(url, str(response.status))
+                    delay = AsyncRequestsManager.retry_delay(response.headers.get("retry-after", ""), attempt)
+                    logger.info(f"Got status {response.status} from {url}, retrying in {delay}s")
+                    return None, delay
+                if response.status != 200:
+                    Metrics.response(url, response.status)
+                    Metrics.failure("fetch", f"status_{response.status}")
+                    logger.warning(f"Request to {url} returned status {response.status}")
+                    return None, None
+                body = await response.read()
+                Metrics.response(url, response.status, len(body))
+                page_text = body.decode(response.get_encoding(), errors="replace")
+                if cache:
+                    cache.put(url, page_text, headers=response.headers)
+                return page_text, None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not last_attempt:
+                Metrics.retry(url, type(e).__name__)
+                return None, RequestsManager.backoff_factor * 2 ** attempt
+            Metrics.failure("fetch", type(e).__name__)
+            logger.error(f"Something went wrong while requesting to {url}\nError: {e}")
+            return None, None
+
+    @staticmethod
+    def retry_delay(retry_after, attempt):
+        """Retry-After seconds capped at RequestsManager.max_retry_after, exponential backoff without the header"""
+        if retry_after.isdigit():
+            return min(int(retry_after), RequestsManager.max_retry_after)
+        return RequestsManager.backoff_factor * 2 ** attempt
+
+
+class RenderProfile:
+    """How pages of a site are rendered in the browser
+
+    Requests of blocked resource types or to blocked hosts are aborted, the page counts as loaded once
+    every ready selector is attached, networkidle is awaited only when wait_networkidle is set
+    """
+    default_blocked_resources = ("image", "media", "font", "stylesheet")
+    default_blocked_hosts = (
+        "google-analytics.com", "googletagmanager.com", "doubleclick.net",
+        "facebook.net", "facebook.com", "hotjar.com", "clarity.ms"
+    )
+
+    def __init__(self, ready_selectors=(), blocked_resources=None, blocked_hosts=None, timeout=20000,
+                 wait_networkidle=False, content_on_timeout=False):
+        self.ready_selectors = list(ready_selectors)
+        self.blocked_resources = set(RenderProfile.default_blocked_resources if blocked_resources is None else blocked_resources)
+        self.blocked_hosts = tuple(RenderProfile.default_blocked_hosts if blocked_hosts is None else blocked_hosts)
+        self.timeout = timeout
+        self.wait_networkidle = wait_networkidle
+        self.content_on_timeout = content_on_timeout
+
+    def is_blocked(self, request):
+        if request.resource_type in self.blocked_resources:
+            return True
+        host = urlsplit(request.url).hostname or ""
+        return any(host == h or host.endswith("." + h) for h in self.blocked_hosts)
+
+    def route_handler(self, route):
+        if self.is_blocked(route.request):
+            route.abort()
+        else:
+            route.continue_()
+
+    def wait_ready(self, page):
+        if self.wait_networkidle:
+            page.wait_for_load_state("networkidle")
+        try:
+            for selector in self.ready_selectors:
+                page.wait_for_selector(selector, state="attached", timeout=self.timeout)
+        except PlaywrightTimeoutError:
+            if not self.content_on_timeout:
+                raise
+            logger.info(f"Ready selectors didn't appear on {page.url}, using what is rendered")
+        return page.content()
+
+
+# Old behaviour: everything is loaded and the page is read after networkidle
+FULL_RENDER = RenderProfile(blocked_resources=(), blocked_hosts=(), wait_networkidle=True)
+
+
+class BrowserSlot:
+    def __init__(self, playwright):
+        self.browser = playwright.chromium.launch(headless=True)
+        self.context = self.browser.new_context(user_agent=RequestsManager.ua.random)
+        self.profile = FULL_RENDER
+        self.context.route("**/*", lambda route: self.profile.route_handler(route))
+        self.tabs = []
+        self.pages_served = 0
+
+    def is_alive(self):
+        return self.browser.is_connected()
+
+    def get_tabs(self, amount):
+        self.tabs = [t for t in self.tabs if not t.is_closed()]
+        while len(self.tabs) < amount:
+            self.tabs.append(self.context.new_page())
+        return self.tabs[:amount]
+
+    def close(self):
+        try:
+            self.browser.close()
+        except PlaywrightError as e:
+            logger.error(f"Failed to close browser: {e}")
+
+
+class BrowserPool:
+    """Warm Chromium shared by a whole crawl
+
+    The browser is handed out with lease(), launched on first lease so crawls served by plain HTTP never start one,
+    relaunched after pages_before_recycle pages or when it crashes. Pages load in parallel in tabs_per_browser tabs.
+    Playwright sync API is bound to its thread so the pool must be used from the thread that opened it, one lease
+    at a time
+    """
+    tabs_per_browser = 4
+    pages_before_recycle = 200
+
+    def __init__(self, tabs_per_browser=None, pages_before_recycle=None):
+        self.tabs_per_browser = tabs_per_browser or BrowserPool.tabs_per_browser
+        self.pages_before_recycle = pages_before_recycle or BrowserPool.pages_before_recycle
+        self.playwright = None
+        self.slot = None
+        self.leased = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.slot:
+            self.slot.close()
+            self.slot = None
+        if self.playwright:
+            self.playwright.stop()
+            self.playwright = None
+
+    def __launch(self):
+        if self.playwright is None:
+            self.playwright = sync_playwright().start()
+        if self.slot:
+            self.slot.close()
+        self.slot = BrowserSlot(self.playwright)
+        return self.slot
+
+    @contextmanager
+    def lease(self):
+        if self.leased:
+            raise RuntimeError("BrowserPool is already leased, leases can't be nested")
+        self.leased = True
+        try:
+            slot = self.slot or self.__launch()
+            if not slot.is_alive():
+                logger.warning("Browser crashed, launching a new one")
+                slot = self.__launch()
+            try:
+                yield slot
+            except PlaywrightError:
+                if not slot.is_alive():
+                    logger.warning("Browser crashed, launching a new one")
+                    self.__launch()
+                raise
+            if slot.pages_served >= self.pages_before_recycle:
+                logger.info(f"Recycling browser after {slot.pages_served} pages")
+                self.__launch()
+        finally:
+            self.leased = False
+
+    def fetch(self, link, profile=FULL_RENDER):
+        cache = RequestsManager.cache
+        cached = cache.lookup(link, namespace="render") if cache else None
+        if cached:
+            return cached
+        for attempt in range(2):
+            try:
+                with self.lease() as slot, Metrics.timer("render", host=Metrics.host(link)):
+                    slot.profile = profile
+                    page = slot.get_tabs(1)[0]
+                    slot.pages_served += 1
+                    page.goto(link, wait_until="commit")
+                    content = profile.wait_ready(page)
+                if cache:
+                    cache.put(link, content, namespace="render")
+                return content
+            except PlaywrightError as e:
+                logger.error(f"Failed to retrieve page content (attempt {attempt + 1}): {e}")
+        return None
+
+    def fetch_many(self, links, profile=FULL_RENDER):
+        """Yields page contents in links order, tabs of one browser load a batch of links in parallel"""
+        cache = RequestsManager.cache
+        cached = {link: cache.lookup(link, namespace="render") for link in links} if cache else {}
+        rendered = self.__render_batches([link for link in links if not cached.get(link)], profile)
+        for link in links:
+            if cached.get(link):
+                yield cached[link]
+                continue
+            content, _ = next(rendered)
+            if content and cache:
+                cache.put(link, content, namespace="render")
+            yield content
+
+    def fetch_many_with_responses(self, links, profile=FULL_RENDER, url_patterns=()):
+        """Yields (content, payloads) in links order, payloads are JSON bodies of the xhr/fetch responses a page
+        received from urls containing one of url_patterns. Always renders, responses aren't kept by the render cache"""
+        return self.__render_batches(links, profile, url_patterns)
+
+    def __render_batches(self, links, profile, url_patterns=()):
+        for i in range(0, len(links), self.tabs_per_browser):
+            batch = links[i:i + self.tabs_per_browser]
+            try:
+                with self.lease() as slot:
+                    slot.profile = profile
+                    tabs = slot.get_tabs(len(batch))
+                    slot.pages_served += len(batch)
+                    captured = [[] for _ in batch]
+                    listeners = [self.__capture_listener(responses, url_patterns) for responses in captured]
+                    for page, listener in zip(tabs, listeners):
+                        page.on("response", listener)
+                    started = time.perf_counter()
+                    for page, link in zip(tabs, batch):
+                        page.goto(link, wait_until="commit")
+                    results = []
+                    for page, link, responses, listener in zip(tabs, batch, captured, listeners):
+                        try:
+                            content = profile.wait_ready(page)
+                            results.append((content, self.__read_json(responses)))
+                        except PlaywrightError as e:
+                            logger.error(f"Failed to load {link}: {e}")
+                            Metrics.failure("render", type(e).__name__)
+                            results.append((None, []))
+                        finally:
+                            page.remove_listener("response", listener)
+                            Metrics.observe("render", time.perf_counter() - started, host=Metrics.host(link))
+            except PlaywrightError as e:
+                logger.error(f"Failed to load batch of links: {e}")
+                results = [(self.fetch(link, profile), []) for link in batch]
+            yield from results
+
+    @staticmethod
+    def __capture_listener(responses, url_patterns):
+        """Response listener keeping api responses, bodies are read after the page is ready as the sync API
+        can't wait for them inside an event handler"""
+        def listener(response):
+            if not url_patterns or response.request.resource_type not in ("xhr", "fetch"):
+                return
+            if any(pattern in response.url for pattern in url_patterns):
+                responses.append(response)
+        return listener
+
+    @staticmethod
+    def __read_json(responses):
+        payloads = []
+        for response in responses:
+            try:
+                if response.ok and "json" in response.headers.get("content-type", ""):
+                    payloads.append(response.json())
+            except (PlaywrightError, ValueError) as e:
+                logger.error(f"Failed to read response of {response.url}: {e}")
+        return payloads
+
+
+class BrowserThread:
+    """BrowserPool for async crawls
+
+    Playwright sync API is bound to the thread that started it, so the pool lives on one worker thread and
+    every render goes there. Renders of concurrent pages queue up for the one browser, which is only launched
+    when some page needs it
+    """
+
+    def __init__(self, tabs_per_browser=None, pages_before_recycle=None):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pool = BrowserPool(tabs_per_browser, pages_before_recycle)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.pool.__exit__, None, None, None)
+        self.executor.shutdown(wait=False)
+
+    async def render_missing(self, urls, fetched, content_check, page_type, profile=None):
+        """RequestsManager.render_missing on the browser thread"""
+        if not any(needs_browser for _, needs_browser in fetched):
+            return [page_text for page_text, _ in fetched]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            lambda: RequestsManager.render_missing(urls, fetched, content_check, page_type, self.pool, profile)
+        )
+
+
+def seen_reference(link):
+    """Yielded instead of a resume the SeenIndex skipped, CandidatesPipeline fills it from the stored profile"""
+    return {"link": link, "seen": True}
 
 
 class RabotaUa:
-    def __init__(self):
-        self.url = 'https://robota.ua/ru/candidates/{position}/{city}?{options}'
-        self.candidate_url = "https://robota.ua"
+    listing_render = RenderProfile(["alliance-employer-cvdb-cv-list-card"], timeout=15000, content_on_timeout=True)
+    candidate_render = RenderProfile(["div.main-content-wrapper", "div.main-info-wrapper h1"])
+
+    # "dom" parses rendered candidate pages, "network" builds candidates from the resume JSON the SPA loads
+    extraction_modes = ("dom", "network")
+    # urls of the api the robota.ua SPA loads resume data from
+    api_url_patterns = ("api.robota.ua", "dracula.robota.ua")
+
+    def __init__(self, site_url="https://robota.ua", extraction_mode="dom", api_url_patterns=None):
+        if extraction_mode not in RabotaUa.extraction_modes:
+            raise ValueError(f"Unknown extraction mode {extraction_mode}, expected one of {RabotaUa.extraction_modes}")
+        self.url = site_url + '/ru/candidates/{position}/{city}?{options}'
+        self.candidate_url = site_url
+        self.extraction_mode = extraction_mode
+        self.api_url_patterns = api_url_patterns or RabotaUa.api_url_patterns
+        self.seen = None
 
     def __prepare_url(self, data):
         def process_lang():
@@ -133,26 +724,36 @@ class RabotaUa:
             options="&".join(params)
         )
 
-    def run_script(self, user_input):
+    def run_script(self, user_input, seen=None):
+        """Generator of candidates, yields each listing page's candidates as soon as the page is parsed"""
         self.__prepare_url(user_input)
-        result = []
+        self.seen = seen
         page = 1
         try:
-            while page < 1000:
-                current_url = self.url + f"&page={page}"
-                logger.info(f"Parsing page {page}\nURL: {current_url}")
-                response = RequestsManager.get_html_playwright(current_url, selector_specified="alliance-employer-cvdb-cv-list")
-                resumes = self.parse_page(response)
-                if resumes == "NO_CANDIDATES_LEFT":
-                    logger.info("All candidates parsed")
-                    break
-                page += 1
-                result.extend(resumes)
+            with BrowserPool() as pool:
+                while page < 1000:
+                    current_url = self.url + f"&page={page}"
+                    logger.info(f"Parsing page {page}\nURL: {current_url}")
+                    response = RequestsManager.fetch(
+                        current_url, self.has_listing_content, "rabota_ua.listing", pool, self.listing_render
+                    )
+                    if not response:
+                        if page == 1:
+                            raise RuntimeError(f"Listing page {current_url} wasn't received")
+                        # a page past the last one is either rendered without cards or not served at all
+                        logger.info(f"Page {page} wasn't received, all candidates parsed")
+                        break
+                    resumes = self.parse_page(response, pool)
+                    if resumes == "NO_CANDIDATES_LEFT":
+                        logger.info("All candidates parsed")
+                        break
+                    page += 1
+                    yield from resumes
         except Exception as e:
-            logger.info(f"Something went wrong: {e}")
-        return result
+            logger.error(f"Something went wrong: {e}")
+            raise
 
-    def parse_page(self, page_text):
+    def parse_page(self, page_text, pool):
 
         if not page_text:
             logger.error("Failed to load the main page content.")
@@ -163,16 +764,66 @@ class RabotaUa:
         if not candidates:
             return "NO_CANDIDATES_LEFT"
         candidates = [self.candidate_url + l for l in candidates]
+        seen = []
+        if self.seen:
+            seen = [l for l in candidates if l in self.seen]
+            candidates = [l for l in candidates if l not in self.seen]
+            logger.info(f"Not fetching {len(seen)} already stored candidates")
+
+        if self.extraction_mode == "network":
+            # the SPA only calls its api in a browser, so every candidate page is rendered
+            contents = pool.fetch_many_with_responses(candidates, self.candidate_render, self.api_url_patterns)
+        else:
+            contents = ((content, []) for content in RequestsManager.fetch_many(
+                candidates, self.has_candidate_content, "rabota_ua.candidate", pool, self.candidate_render
+            ))
+
+        resumes = {}
+        to_parse = []
+        for link, (candidate_content, payloads) in zip(candidates, contents):
+            if not candidate_content:
+                logger.error(f"Candidate {link} wasn't loaded")
+                continue
+            candidate = self.candidate_from_json(payloads, link) if payloads else None
+            resumes[link] = candidate
+            if not candidate:
+                to_parse.append((candidate_content, link))
+        for candidate in ParserPool.parse("rabota_ua.candidate", to_parse):
+            if candidate:
+                resumes[candidate["link"]] = candidate
+        return [seen_reference(l) for l in seen] + [c for c in resumes.values() if c]
 
-        resumes = []
-        k = 0
-        for candidate_content in RequestsManager.iterate_links(candidates):
-            candidate = self.parse_candidate(BeautifulSoup(candidate_content, "lxml"))
-            candidate["link"] = candidates[k]
-            print(candidate)
-            resumes.append(candidate)
-            k += 1
-        return resumes
+    @staticmethod
+    def parse_candidate_page(text_content, link):
+        candidate = RabotaUa.parse_candidate(BeautifulSoup(text_content, "lxml"))
+        candidate["link"] = link
+        return candidate
+
+    @staticmethod
+    def candidate_from_json(payloads, link):
+        """parse_candidate_json of the captured payloads, None sends the page to the DOM parser"""
+        try:
+            candidate = RabotaUa.parse_candidate_json(payloads)
+        except Exception as e:
+            logger.error(f"Resume JSON of {link} wasn't parsed, parsing the page: {e}")
+            return None
+        if not candidate:
+            logger.info(f"No resume JSON captured for {link}, parsing the page")
+            return None
+        candidate["link"] = link
+        return candidate
+
+    @staticmethod
+    def resume_id(link):
+        return urlsplit(link).path.rstrip("/")
+
+    @staticmethod
+    def has_listing_content(page_text):
+        return "alliance-employer-cvdb-cv-list-card" in page_text
+
+    @staticmethod
+    def has_candidate_content(page_text):
+        return "main-info-wrapper" in page_text
 
     @staticmethod
     def get_candidates_links(soup: BeautifulSoup):
@@ -216,7 +867,6 @@ class RabotaUa:
                     user_jobs.append(job)
                 except Exception as e:
                     logger.error(f"Something went wrong while parsing job experience: {e}")
-            print(user_jobs)
             return user_jobs
 
         def parse_education(tag):
@@ -306,18 +956,140 @@ class RabotaUa:
         )
         return user
 
+    @staticmethod
+    def parse_candidate_json(payloads):
+        """Candidate with the keys of parse_candidate built from resume JSON captured from the SPA, {} when no
+        payload holds a resume
+
+        A resume is the first dict holding two of resume_keys, fields are read from a few known name variants
+        and a field of unexpected type is left empty instead of failing the candidate.
+        The shape is the one benchmarks/mock_board.py serves, see tests/test_rabota_ua_json.py
+        """
+        resume_keys = {"fullName", "experiences", "experience", "educations", "education", "skills", "languages"}
+
+        def find_resume(payload, depth=0):
+            if depth > 8:
+                return None
+            children = []
+            if isinstance(payload, dict):
+                if len(resume_keys & payload.keys()) >= 2:
+                    return payload
+                children = payload.values()
+            elif isinstance(payload, list):
+                children = payload
+            for child in children:
+                found = find_resume(child, depth + 1)
+                if found:
+                    return found
+            return None
+
+        def text(value):
+            if isinstance(value, str):
+                return value.strip() or None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return str(value)
+            return None
+
+        def field(d, *keys):
+            for key in keys:
+                if d.get(key) is not None:
+                    return d[key]
+            return None
+
+        def first_text(d, *keys):
+            for key in keys:
+                value = text(d.get(key))
+                if value:
+                    return value
+            return None
+
+        def joined(*values):
+            return " ".join(filter(None, map(text, values))) or None
+
+        def records(value):
+            return [v for v in value if isinstance(v, dict)] if isinstance(value, list) else []
+
+        def names(value):
+            if isinstance(value, str):
+                return [line.strip() for line in value.splitlines() if line.strip()]
+            if not isinstance(value, list):
+                return []
+            found = (first_text(v, "name", "title") if isinstance(v, dict) else text(v) for v in value)
+            return [name for name in found if name]
+
+        resume = None
+        for payload in payloads:
+            resume = find_resume(payload)
+            if resume:
+                break
+        if not resume:
+            return {}
+
+        user = {}
+        user["job_experience"] = [
+            {
+                "position": first_text(job, "position", "positionName", "title"),
+                "company_name": first_text(job, "company", "companyName"),
+                "working_time": first_text(job, "period", "datesDiff"),
+                "description": first_text(job, "description", "achievements"),
+            }
+            for job in records(field(resume, "experiences", "experience"))
+        ]
+        user["education"] = [
+            {
+                "name": first_text(edu, "name", "schoolName", "institution"),
+                "specialisation": first_text(edu, "speciality", "specialization", "faculty"),
+                "place_and_time": joined(edu.get("location"), edu.get("yearOfGraduation")),
+            }
+            for edu in records(field(resume, "educations", "education"))
+        ]
+        skills = names(field(resume, "skills", "skillsSummary"))
+        user["skills"] = {"skills": skills, "full_description": "\n".join(skills)}
+        user["languages"] = names(field(resume, "languages", "languageSkills"))
+        additional_info = first_text(resume, "additionalInfo", "about")
+        if additional_info:
+            user["additional_info"] = additional_info
+        user["name"] = first_text(resume, "fullName", "name") or joined(resume.get("firstName"), resume.get("lastName"))
+        user["employment"] = first_text(resume, "scheduleName", "schedule", "employment")
+        return user
+
     def test_url(self, u_input):
         self.__prepare_url(u_input)
         print(self.url)
 
 
 class WorkuaParser:
-
-    def __init__(self):
-        self.base_url = "https://www.work.ua/resumes"
+    resume_block_pattern = re.compile(r'id="(?:resume_\d+|add_info)"')
+
+    # headers of uploaded file resumes, a header takes the whole line or is followed by a colon
+    section_headers = {
+        "job_experience": ("WORK EXPERIENCE", "PROFESSIONAL EXPERIENCE", "EMPLOYMENT HISTORY", "EXPERIENCE",
+                           "Досвід роботи", "Досвід", "Опыт работы", "Опыт"),
+        "education": ("EDUCATION", "Освіта", "Образование"),
+        "skills_stack": ("TECHNICAL SKILLS", "TECH SKILLS", "KEY SKILLS", "SKILLS", "Ключові навички",
+                         "Професійні навички", "Навички", "Навыки"),
+        "languages": ("LANGUAGES", "Знання мов", "Володіння мовами", "Мови", "Языки"),
+        "summary": ("SUMMARY", "PROFILE", "ABOUT ME", "OBJECTIVE", "Про себе", "Профіль", "О себе", "Цель"),
+        "courses": ("CERTIFICATIONS", "CERTIFICATES", "COURSES", "TRAININGS", "Сертифікати", "Курси",
+                    "Тренінги", "Курсы"),
+        "projects": ("PROJECTS", "Проєкти", "Проекти", "Проекты"),
+        "contacts": ("CONTACT INFORMATION", "CONTACTS", "CONTACT", "Контактна інформація", "Контакти", "Контакты"),
+    }
+    section_pattern = re.compile(
+        r'^[ \t]*(?:' +
+        "|".join(f"(?P<{section}>{'|'.join(map(re.escape, headers))})" for section, headers in section_headers.items()) +
+        r')[ \t]*(?::[ \t]*|$)',
+        re.MULTILINE | re.IGNORECASE
+    )
+    name_pattern = re.compile(r'^[A-ZА-ЯЇІЄҐ][a-zа-яїієґ\'’-]+[ \t]+[A-ZА-ЯЇІЄҐ][a-zа-яїієґ\'’-]+', re.MULTILINE)
+
+    def __init__(self, site_url="https://www.work.ua"):
+        self.base_url = site_url + "/resumes"
         self.url = ""
-        self.resume_url_base = "https://www.work.ua"
+        self.resume_url_base = site_url
         self.config = {}
+        self.page_concurrency = 8
+        self.seen = None
 
     def __prepare_url(self, data):
         def process_lang():
@@ -381,37 +1153,46 @@ class WorkuaParser:
             resumes_links.append(resume.find("h2", {"class": "mt-0"}).find("a").get("href"))
         return resumes_links
 
-    def __parse_page(self, soup):
-        resume_block = self.__get_resume_list(soup)
-        if not resume_block:
-            return []
+    @staticmethod
+    def parse_listing(page_text):
+        """Resume links of the listing page (None when there is no resume list) and amount of pages"""
+        soup = BeautifulSoup(page_text, "lxml")
+        resume_block = WorkuaParser.__get_resume_list(soup)
+        links = WorkuaParser.__parse_resume_links(resume_block) if resume_block else None
+        return links, WorkuaParser.__count_pages(soup)
 
-        candidates_links = self.__parse_resume_links(resume_block)
-        threads = []
-        result = []
-        lock = threading.Lock()
+    def __listing_links(self, page_text):
+        links, _ = ParserPool.html_backend().work_ua_listing(page_text)
+        return self.__skip_seen([self.resume_url_base + l for l in links or []])
 
-        def worker(link):
-            r = WorkuaParser.__parse_candidate(link)
-            with lock:
-                result.append(r)
+    def __parse_page(self, page_text, executor):
+        """Queues download of every resume of the listing page, returns (link, future) pairs in listing order,
+        the future is None for resumes the SeenIndex skipped"""
+        candidates_links, seen = self.__listing_links(page_text)
+        return [(link, None) for link in seen] + \
+            [(link, executor.submit(WorkuaParser.__fetch_candidate, link)) for link in candidates_links]
 
-        for l in candidates_links:
-            url = self.resume_url_base + l
-            thread = threading.Thread(
-                target=worker,
-                args=(url,)
-            )
-            threads.append(thread)
-            thread.start()
+    @staticmethod
+    def __fetch_candidate(link):
+        """Runs on executor threads, so plain HTTP only, pages that need the browser are rendered by the consumer"""
+        text_content, needs_browser = RequestsManager.fetch_http(
+            link, WorkuaParser.has_resume_content, "work_ua.resume"
+        )
+        if not text_content and not needs_browser:
+            logger.error(f"Resume {link} wasn't received")
+        return text_content, needs_browser
 
-        for t in threads:
-            t.join()
-        return result
+    @staticmethod
+    def __resume_pages(page_fetches, pool):
+        """Waits for the resumes of a listing page, renders the ones plain HTTP couldn't get, (html, link) pairs"""
+        page_fetches = [(link, future) for link, future in page_fetches if future]
+        links = [link for link, _ in page_fetches]
+        fetched = [future.result() or (None, False) for _, future in page_fetches]
+        texts = RequestsManager.render_missing(links, fetched, WorkuaParser.has_resume_content, "work_ua.resume", pool)
+        return [(html, link) for html, link in zip(texts, links) if html]
 
     @staticmethod
-    def __parse_candidate(link):
-        text_content = RequestsManager.make_request(link)
+    def parse_candidate_page(text_content, link):
         soup = BeautifulSoup(text_content, parser="lxml")
         check_file_resume = [p.get_text().strip() == "Завантажений файл" for p in
                              soup.find_all("h2", {"class": "mb-0"})]
@@ -431,28 +1212,30 @@ class WorkuaParser:
 
     @staticmethod
     def plain_text_parser(profile, user):
-        profile = profile.get_text()
-        name_pattern = re.compile(r'^[A-ZА-ЯЇІЄҐ][a-zа-яїієґ]+\s[A-ZА-ЯЇІЄҐ][a-zа-яїієґ]+', re.MULTILINE)
-        education_pattern = re.compile(r'(?:EDUCATION|Освіта)(.*?)\n(?:\n|$)', re.DOTALL | re.IGNORECASE)
-        skills_pattern = re.compile(r'(?:SKILLS|Навички|TECH SKILLS)(.*?)\n(?:\n|$)', re.DOTALL | re.IGNORECASE)
-        experience_pattern = re.compile(r'(?:EXPERIENCE|Досвід роботи|WORK EXPERIENCE)(.*?)\n(?:\n|$)',
-                                        re.DOTALL | re.IGNORECASE)
-
-        name_match = name_pattern.search(profile)
-        name = name_match.group(0).strip() if name_match else "Not found"
-
-        education_match = education_pattern.search(profile)
-        education = education_match.group(1).strip() if education_match else "Not found"
-
-        skills_match = skills_pattern.search(profile)
-        skills = skills_match.group(1).strip() if skills_match else "Not found"
-
-        experience_match = experience_pattern.search(profile)
-        experience = experience_match.group(1).strip() if experience_match else "Not found"
-        user["name"] = name
-        user["job_experience"] = experience
-        user["education"] = education
-        user["skills_stack"] = skills
+        return WorkuaParser.parse_plain_text(profile.get_text(), user)
+
+    @staticmethod
+    def split_sections(profile):
+        """Splits resume text into known sections in one pass, returns the text before the first header and
+        section -> content, content of repeated headers is joined
+        """
+        sections = {}
+        matches = list(WorkuaParser.section_pattern.finditer(profile))
+        preamble = profile[:matches[0].start()] if matches else profile
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            content = profile[match.end():next_match.start() if next_match else len(profile)].strip()
+            if content:
+                sections[match.lastgroup] = f"{sections[match.lastgroup]}\n{content}" if match.lastgroup in sections else content
+        return preamble, sections
+
+    @staticmethod
+    def parse_plain_text(profile, user):
+        preamble, sections = WorkuaParser.split_sections(profile)
+
+        name_match = WorkuaParser.name_pattern.search(preamble) or WorkuaParser.name_pattern.search(profile)
+        user["name"] = name_match.group(0).strip() if name_match else "Not found"
+        for section in WorkuaParser.section_headers:
+            user[section] = sections.get(section, "Not found")
         return user
 
     @staticmethod
@@ -577,6 +1360,30 @@ class WorkuaParser:
 
         return user
 
+    @staticmethod
+    def resume_id(link):
+        return link.rstrip("/").split("/")[-1]
+
+    def __skip_seen(self, links):
+        """(links to fetch, links of already stored resumes)"""
+        if not self.seen:
+            return links, []
+        seen = [l for l in links if l in self.seen]
+        logger.info(f"Not fetching {len(seen)} already stored resumes")
+        return [l for l in links if l not in self.seen], seen
+
+    @staticmethod
+    def has_listing_content(page_text):
+        return 'id="pjax-resume-list"' in page_text
+
+    @staticmethod
+    def has_resume_content(page_text):
+        return WorkuaParser.resume_block_pattern.search(page_text) is not None
+
+    @staticmethod
+    def __fetch_listing(url, pool):
+        return RequestsManager.fetch(url, WorkuaParser.has_listing_content, "work_ua.listing", pool)
+
     @staticmethod
     def __get_resume_list(soup):
         return soup.find("div", {"id": "pjax-resume-list"})
@@ -593,29 +1400,593 @@ class WorkuaParser:
                         pages = int(span_title.split()[-1])
         return pages
 
-    def run_script(self, user_input):
+    def run_script(self, user_input, seen=None):
+        """Generator of candidates in listing order, resumes are fetched ahead while earlier ones are consumed"""
         self.__prepare_url(user_input)
+        self.seen = seen
         logger.info(f"Created url: {self.url}")
-        page_text = RequestsManager.make_request(self.url)
+        # the browser is bound to this thread, fetch threads only use plain HTTP and hand pages lacking content back
+        with BrowserPool() as pool:
+            yield from self.__crawl(pool)
+
+    def __crawl(self, pool):
+        page_text = self.__fetch_listing(self.url, pool)
 
         if not page_text:
-            logger.info("Page doesn't received")
-            return
+            raise RuntimeError(f"Listing page {self.url} wasn't received")
 
-        soup_obj = BeautifulSoup(page_text, parser="lxml")
-        pages_amt = self.__count_pages(soup_obj)
+        _, pages_amt = ParserPool.html_backend().work_ua_listing(page_text)
 
         if pages_amt == 0:
             logger.info("No pages found")
 
-        resumes = []
         try:
-            resumes.extend(self.__parse_page(soup_obj))
-            for i in range(2, pages_amt):
-                page_text = RequestsManager.make_request(self.url + f"&page={i}")
-                soup_obj = BeautifulSoup(page_text, parser="lxml")
-                resumes.extend(self.__parse_page(soup_obj))
+            pages_urls = (self.url + f"&page={i}" for i in range(2, pages_amt + 1))
+            with BoundedExecutor() as executor, \
+                    BoundedExecutor(max_workers=self.page_concurrency, queue_size=self.page_concurrency) as pages_executor:
+                # downloaded pages go to the parser processes, a few pages are parsed ahead of the consumer
+                parsing = deque()
+                for page_fetches in self.__listing_pages(page_text, pages_urls, executor, pages_executor, pool):
+                    yield from (seen_reference(link) for link, future in page_fetches if future is None)
+                    items = self.__resume_pages(page_fetches, pool)
+                    parsing.append(ParserPool.submit("work_ua.resume", items))
+                    while len(parsing) > ParserPool.pages_ahead:
+                        yield from ParserPool.results(parsing.popleft())
+                while parsing:
+                    yield from ParserPool.results(parsing.popleft())
         except Exception as e:
             logger.error(f"Something went wrong: {e}")
-        return resumes
+            raise
+
+    def __listing_pages(self, page_text, pages_urls, executor, pages_executor, pool):
+        """Yields (link, future) pairs of every listing page in order, only page_concurrency listing pages
+        are fetched ahead of the consumer and each of them queues its resumes on executor as soon as it arrives"""
+        listing = deque()
+
+        def queue_next():
+            url = next(pages_urls, None)
+            if url:
+                job = pages_executor.submit(lambda page_url: self.__queue_listing_page(page_url, executor), url)
+                listing.append((url, job))
+
+        for _ in range(self.page_concurrency):
+            queue_next()
+        yield self.__parse_page(page_text, executor)
+        while listing:
+            url, job = listing.popleft()
+            queued = job.result()
+            if queued is None:
+                raise RuntimeError(f"Listing page {url} wasn't received")
+            page_fetches, fetched = queued
+            queue_next()
+            if page_fetches is None:
+                page_text = RequestsManager.render_missing(
+                    [url], [fetched], WorkuaParser.has_listing_content, "work_ua.listing", pool
+                )[0]
+                if not page_text:
+                    raise RuntimeError(f"Listing page {url} wasn't received")
+                page_fetches = self.__parse_page(page_text, executor)
+            yield page_fetches
+
+    def __queue_listing_page(self, url, executor):
+        """Fetches a listing page with plain HTTP and queues its resumes, returns (page_fetches, fetch_http result),
+        page_fetches is None when the page needs the browser or wasn't received"""
+        fetched = RequestsManager.fetch_http(url, WorkuaParser.has_listing_content, "work_ua.listing")
+        page_text, needs_browser = fetched
+        if needs_browser or not page_text:
+            return None, fetched
+        return self.__parse_page(page_text, executor), fetched
+
+    async def run_script_async(self, user_input, concurrency=None, seen=None):
+        """Async iterator version of run_script, listing and resume pages are fetched concurrently on the running
+        event loop and candidates are yielded page by page as pages complete. Like run_script only
+        page_concurrency listing pages are in flight ahead of the consumer, the next one starts as one is done"""
+        self.__prepare_url(user_input)
+        self.seen = seen
+        logger.info(f"Created url: {self.url}")
+
+        async with AsyncRequestsManager(concurrency=concurrency) as manager, BrowserThread() as browser:
+            page_text = await self.__fetch_listing_async(manager, browser, self.url)
+            if not page_text:
+                raise RuntimeError(f"Listing page {self.url} wasn't received")
+
+            _, pages_amt = ParserPool.html_backend().work_ua_listing(page_text)
+            if pages_amt == 0:
+                logger.info("No pages found")
+
+            pages_urls = (self.url + f"&page={i}" for i in range(2, pages_amt + 1))
+            pages = {asyncio.ensure_future(self.__parse_page_async(manager, browser, page_text))}
+
+            def queue_next():
+                url = next(pages_urls, None)
+                if url:
+                    pages.add(asyncio.ensure_future(self.__fetch_page_async(manager, browser, url)))
+
+            # the first page counts against page_concurrency too, each page done makes room for the next one
+            for _ in range(self.page_concurrency - 1):
+                queue_next()
+            try:
+                while pages:
+                    done, _ = await asyncio.wait(pages, return_when=asyncio.FIRST_COMPLETED)
+                    for page in done:
+                        pages.discard(page)
+                        queue_next()
+                        try:
+                            page_result = page.result()
+                        except Exception as e:
+                            logger.error(f"Something went wrong: {e}")
+                            raise
+                        for candidate in page_result:
+                            yield candidate
+            finally:
+                for page in pages:
+                    page.cancel()
+
+    @staticmethod
+    async def __fetch_listing_async(manager, browser, url):
+        fetched = await manager.fetch_http(url, WorkuaParser.has_listing_content, "work_ua.listing")
+        return (await browser.render_missing([url], [fetched], WorkuaParser.has_listing_content, "work_ua.listing"))[0]
+
+    async def __fetch_page_async(self, manager, browser, url):
+        page_text = await self.__fetch_listing_async(manager, browser, url)
+        if not page_text:
+            raise RuntimeError(f"Listing page {url} wasn't received")
+        return await self.__parse_page_async(manager, browser, page_text)
+
+    async def __parse_page_async(self, manager, browser, page_text):
+        links, seen = self.__listing_links(page_text)
+        fetched = await asyncio.gather(
+            *(manager.fetch_http(l, WorkuaParser.has_resume_content, "work_ua.resume") for l in links),
+            return_exceptions=True
+        )
+        fetched = [(None, False) if isinstance(result, Exception) else result for result in fetched]
+        pages = await browser.render_missing(links, fetched, WorkuaParser.has_resume_content, "work_ua.resume")
+        items = []
+        for link, page in zip(links, pages):
+            if not page:
+                logger.error(f"Resume {link} wasn't received")
+            else:
+                items.append((page, link))
+        return [seen_reference(l) for l in seen] + await ParserPool.parse_async("work_ua.resume", items)
 
+
+class BeautifulSoupBackend:
+    """Reference html backend, builds full BeautifulSoup trees"""
+
+    @staticmethod
+    def work_ua_listing(page_text):
+        return WorkuaParser.parse_listing(page_text)
+
+    @staticmethod
+    def work_ua_resume(page_text, link):
+        return WorkuaParser.parse_candidate_page(page_text, link)
+
+    @staticmethod
+    def rabota_ua_candidate(page_text, link):
+        return RabotaUa.parse_candidate_page(page_text, link)
+
+
+def class_xpath(class_name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+class LxmlBackend:
+    """Fast html backend on raw lxml trees and precompiled XPath, returns the same candidates as BeautifulSoupBackend
+
+    Every lookup mirrors the BeautifulSoup call it replaces: find -> first match in document order,
+    find_next_sibling -> itersiblings, find_previous -> nearest preceding or ancestor element
+    """
+    # text of a subtree the way BeautifulSoup get_text sees it, without script/style/template strings
+    text_nodes = etree.XPath("descendant::text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+
+    resume_list = etree.XPath("//div[@id='pjax-resume-list']")
+    resume_cards = etree.XPath(
+        "descendant::div[normalize-space(@class)='card card-hover card-search resume-link card-visited wordwrap']"
+    )
+    card_title = etree.XPath(f"descendant::h2[{class_xpath('mt-0')}]")
+    navs = etree.XPath("//nav")
+    descendant_li = etree.XPath("descendant::li")
+    descendant_span = etree.XPath("descendant::span")
+
+    file_resume_headers = etree.XPath(f"//h2[{class_xpath('mb-0')}]")
+    file_resume_block = etree.XPath(f"//div[{class_xpath('wordwrap')} and @id='add_info']")
+    resume_block = etree.XPath("//div[@id=$block_id]")
+    base_info = etree.XPath(f"descendant::div[{class_xpath('mt-lg')}]")
+    skills_header = etree.XPath(f"descendant::h2[{class_xpath('mb-sm')}]")
+
+    article = etree.XPath("//article")
+    previous_section = etree.XPath("(preceding::section | ancestor::section)[last()]")
+    job_divs = etree.XPath(
+        "descendant::div[normalize-space(@class)='santa-mt-20 santa-mb-20 760:santa-mb-40 last:santa-mb-0 ng-star-inserted']"
+    )
+    main_info = etree.XPath(f"//div[{class_xpath('main-info-wrapper')}]")
+    main_info_employment = etree.XPath(f"descendant::div[{class_xpath('santa-mt-20')}]")
+
+    @staticmethod
+    def document(page_text):
+        try:
+            return lxml.html.document_fromstring(page_text)
+        except ValueError:
+            # str with an xml encoding declaration
+            return lxml.html.document_fromstring(page_text.encode("utf-8"))
+
+    ascii_spaces = "\x20\x0a\x09\x0c\x0d"
+    preserve_whitespace_tags = ("pre", "textarea")
+
+    @staticmethod
+    def string(node):
+        """BeautifulSoup collapses whitespace only strings outside of pre/textarea into a single newline or space"""
+        if node.strip(LxmlBackend.ascii_spaces):
+            return node
+        container = node.getparent().getparent() if node.is_tail else node.getparent()
+        while container is not None:
+            if container.tag in LxmlBackend.preserve_whitespace_tags:
+                return node
+            container = container.getparent()
+        return "\n" if "\n" in node else " "
+
+    @staticmethod
+    def text(el, strip=False):
+        strings = [LxmlBackend.string(t) for t in LxmlBackend.text_nodes(el)]
+        if strip:
+            return "".join(t.strip() for t in strings if t.strip())
+        return "".join(strings)
+
+    @staticmethod
+    def first(elements):
+        return elements[0] if elements else None
+
+    @staticmethod
+    def find(el, tag):
+        return next(el.iterdescendants(tag), None)
+
+    @staticmethod
+    def next_sibling(el, tag):
+        return next(el.itersiblings(tag), None)
+
+    @staticmethod
+    def work_ua_listing(page_text):
+        doc = LxmlBackend.document(page_text)
+        links = None
+        resume_block = LxmlBackend.first(LxmlBackend.resume_list(doc))
+        if resume_block is not None:
+            links = []
+            for card in LxmlBackend.resume_cards(resume_block):
+                title = LxmlBackend.first(LxmlBackend.card_title(card))
+                links.append(LxmlBackend.find(title, "a").get("href"))
+
+        pages = 0
+        for nav in LxmlBackend.navs(doc):
+            for li in LxmlBackend.descendant_li(nav):
+                span = LxmlBackend.first(LxmlBackend.descendant_span(li))
+                if span is not None:
+                    span_title = span.get("title")
+                    if span_title and span_title.startswith("Стор."):
+                        pages = int(span_title.split()[-1])
+        return links, pages
+
+    @staticmethod
+    def work_ua_resume(page_text, link):
+        doc = LxmlBackend.document(page_text)
+        text = LxmlBackend.text
+        user = {"link": link}
+        if any(text(h).strip() == "Завантажений файл" for h in LxmlBackend.file_resume_headers(doc)):
+            user["resume_type"] = "FILE"
+            content_block = LxmlBackend.first(LxmlBackend.file_resume_block(doc))
+            if content_block is None:
+                raise AttributeError("File resume block not found")
+            return WorkuaParser.parse_plain_text(text(content_block), user)
+
+        user["resume_type"] = "WORKUA"
+        content_block = LxmlBackend.first(LxmlBackend.resume_block(doc, block_id=f"resume_{link.split('/')[-2]}"))
+        if content_block is None:
+            raise AttributeError("Resume block not found")
+        return LxmlBackend.work_ua_template(content_block, user)
+
+    @staticmethod
+    def work_ua_template(block, user):
+        text, find, next_sibling = LxmlBackend.text, LxmlBackend.find, LxmlBackend.next_sibling
+        user["unprocessed_info"] = []
+
+        base_info = LxmlBackend.first(LxmlBackend.base_info(block))
+        try:
+            user["name"] = text(find(base_info, "h1")).strip()
+            spec = text(find(base_info, "h2")).strip()
+            if "грн" in spec:
+                spec = spec.split(",")
+                salary = spec[-1]
+                spec = " ".join(spec[:-1])
+                user["salary"] = salary
+            user["occupation"] = spec
+
+            for k, v in zip(base_info.iterdescendants("dt"), base_info.iterdescendants("dd")):
+                k, v = text(k).strip(), text(v).strip()
+                if "Вік" in k:
+                    user["age"] = v
+                elif "Зайнятість" in k:
+                    user["employment_type"] = v
+                elif "Місто проживання" in k:
+                    user["living_city"] = v
+                elif "Готовий працювати" in k:
+                    user["working_where"] = v
+                else:
+                    user["unprocessed_info"].append((k, v))
+        except (AttributeError, TypeError) as e:
+            logger.error(f"Something went wrong while parsing base info: {e}")
+            user["unprocessed_info"].append("Base info wasn't parsed")
+
+        job_experience = []
+        job_tag = next((h for h in block.iterdescendants("h2") if "Досвід" in text(h, strip=True)), None)
+        if job_tag is not None:
+            job_tag = next_sibling(job_tag, "h2")
+            while job_tag is not None and "Осв" not in text(job_tag).strip():
+                next_p = next_sibling(job_tag, "p")
+                description_p = next_sibling(next_p, "p") if next_p is not None else None
+                job_experience.append({
+                    "title": text(job_tag).strip(),
+                    "company_name_and_time": text(next_p).strip() if next_p is not None else "No company name provided",
+                    "description": text(description_p, strip=True).strip() if description_p is not None else "No description provided"
+                })
+                job_tag = next_sibling(job_tag, "h2")
+        user["job_experience"] = job_experience
+
+        education = []
+        education_tag = next_sibling(job_tag, "h2") if job_tag is not None else None
+        while education_tag is not None and "Знання" not in text(education_tag).strip():
+            description_p = next_sibling(education_tag, "p")
+            if description_p is None:
+                logger.error("Education info wasnt parsed: no description")
+                break
+            education.append({"title": text(education_tag).strip(), "description": text(description_p, strip=True).strip()})
+            education_tag = next_sibling(education_tag, "h2")
+        user["education"] = education
+
+        skills_tag = LxmlBackend.first(LxmlBackend.skills_header(block))
+        skill_list = []
+        if skills_tag is not None:
+            skills_ul = next_sibling(skills_tag, "ul")
+            for li in skills_ul.iterdescendants("li") if skills_ul is not None else ():
+                span = find(li, "span")
+                if span is None:
+                    logger.error("Skills info wasnt parsed: no span")
+                    break
+                skill_list.append(text(span).strip())
+        user["skill_stack"] = skill_list
+
+        language_list = []
+        language_tag = next_sibling(skills_tag, "h2") if skills_tag is not None else None
+        if language_tag is not None:
+            languages_ul = next_sibling(language_tag, "ul")
+            if languages_ul is None:
+                logger.error("languages info wasnt parsed: no list")
+            else:
+                language_list = [text(li).strip() for li in languages_ul.iterdescendants("li")]
+        user["language"] = language_list
+        return user
+
+    @staticmethod
+    def rabota_ua_candidate(page_text, link):
+        doc = LxmlBackend.document(page_text)
+        text, find, next_sibling = LxmlBackend.text, LxmlBackend.find, LxmlBackend.next_sibling
+        user_info = LxmlBackend.first(LxmlBackend.article(doc))
+        if user_info is None:
+            logger.error("Failed to find user information section.")
+            return {"link": link}
+
+        def section(tag):
+            return LxmlBackend.first(LxmlBackend.previous_section(tag))
+
+        def parse_job_experience(tag):
+            user_jobs = []
+            job_section = section(tag)
+            if job_section is None:
+                logger.error("Failed to find job section.")
+                return user_jobs
+            for div in LxmlBackend.job_divs(job_section):
+                try:
+                    position = find(div, "h4")
+                    job_block = next_sibling(position, "div")
+                    company_name = next(job_block.iterchildren("div"), None)
+                    description = find(next_sibling(company_name, "div"), "div")
+                    working_time = find(description, "div")
+                    description = next_sibling(working_time, "div")
+                    user_jobs.append({
+                        "position": text(position).strip(),
+                        "company_name": text(company_name).strip(),
+                        "working_time": text(working_time).strip(),
+                        "description": text(description).strip() if description is not None else None
+                    })
+                except (AttributeError, TypeError) as e:
+                    logger.error(f"Something went wrong while parsing job experience: {e}")
+            return user_jobs
+
+        def parse_education(tag):
+            user_education = []
+            edu_section = section(tag)
+            if edu_section is None:
+                logger.error("Failed to find education section.")
+                return user_education
+            for div in edu_section.iterdescendants("div"):
+                try:
+                    institution_name = find(div, "h4")
+                    spec = find(next_sibling(institution_name, "div"), "div")
+                    place_and_time = next_sibling(spec, "div")
+                    user_education.append({
+                        "name": text(institution_name),
+                        "specialisation": text(spec),
+                        "place_and_time": text(place_and_time) if place_and_time is not None else None
+                    })
+                except (AttributeError, TypeError) as e:
+                    logger.error(f"Something went wrong while parsing university: {e}")
+            return user_education
+
+        def parse_skills(tag):
+            skills = {"skills": []}
+            skills_block = section(tag)
+            brs = list(skills_block.iterdescendants("br"))
+            if brs:
+                skills["skills"] = [text(b).strip() for b in brs]
+            else:
+                skills["skills"] = [text(p).strip() for p in skills_block.iterdescendants("p")]
+            skills["full_description"] = text(skills_block).strip()
+            return skills
+
+        def parse_about_block(tag):
+            div = find(section(tag), "div")
+            if div is not None:
+                return text(div).strip()
+
+        def parse_langs(tag):
+            return [text(h).strip() for h in section(tag).iterdescendants("h4")]
+
+        user = {}
+        for key_ in user_info.iterdescendants("h3"):
+            key = text(key_).strip()
+            if key.startswith("Прац") or key.startswith("Рабо"):
+                user["job_experience"] = parse_job_experience(key_)
+            elif key.startswith("Навч") or key.startswith("Учил"):
+                user["education"] = parse_education(key_)
+            elif key.startswith("Додаткова") or key.startswith("Дополнительная"):
+                user["additional_info"] = parse_about_block(key_)
+            elif key.startswith("Володіє") or key.startswith("Владеет"):
+                user["languages"] = parse_langs(key_)
+            elif key.startswith("Ключова") or key.startswith("Ключев"):
+                user["skills"] = parse_skills(key_)
+
+        block = LxmlBackend.first(LxmlBackend.main_info(doc))
+        user["name"] = text(find(block, "h1")).strip()
+        employment = LxmlBackend.first(LxmlBackend.main_info_employment(block))
+        user["employment"] = text(employment) if employment is not None else None
+        user["link"] = link
+        return user
+
+
+HTML_BACKENDS = {"bs4": BeautifulSoupBackend, "lxml": LxmlBackend}
+
+
+def parse_batch(kind, items, backend="bs4"):
+    """Runs in parser processes, turns (html, link) pairs into candidates, None for pages that failed to parse
+
+    Returns the candidates with the parse time of every page and the error types, metrics of the child
+    process are not visible to the bot so they are recorded by the caller with ParserPool.record
+    """
+    parse = getattr(HTML_BACKENDS[backend], kind.replace(".", "_"))
+    result, timings, errors = [], [], []
+    for html, link in items:
+        started = time.perf_counter()
+        try:
+            result.append(parse(html, link))
+        except Exception as e:
+            logger.error(f"Failed to parse candidate {link}: {e}")
+            result.append(None)
+            errors.append(type(e).__name__)
+        timings.append(time.perf_counter() - started)
+    return result, timings, errors
+
+
+class ParserPool:
+    """Process pool for CPU bound html parsing shared by every crawl of the process
+
+    Pages are sent in batches of batch_size to keep pickling overhead low, with max_workers = 0 pages are
+    parsed in the calling thread
+    """
+    max_workers = os.cpu_count() or 1
+    batch_size = 8
+    pages_ahead = 2
+    # key of HTML_BACKENDS used for listing and candidate pages
+    backend = "bs4"
+
+    _executor = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def executor():
+        with ParserPool._lock:
+            if ParserPool._executor is None:
+                # spawn instead of fork, the bot process forks while crawler threads hold locks
+                ParserPool._executor = ProcessPoolExecutor(
+                    max_workers=ParserPool.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return ParserPool._executor
+
+    @staticmethod
+    def html_backend():
+        return HTML_BACKENDS[ParserPool.backend]
+
+    @staticmethod
+    def shutdown():
+        with ParserPool._lock:
+            if ParserPool._executor is not None:
+                ParserPool._executor.shutdown(wait=True)
+                ParserPool._executor = None
+
+    @staticmethod
+    def record(kind, parsed):
+        """Observes parse times of a parse_batch result and returns its candidates"""
+        candidates, timings, errors = parsed
+        for seconds in timings:
+            Metrics.observe("parse", seconds, kind=kind)
+        for error in errors:
+            Metrics.failure("parse", error)
+        return candidates
+
+    @staticmethod
+    def __batches(items):
+        return [items[i:i + ParserPool.batch_size] for i in range(0, len(items), ParserPool.batch_size)]
+
+    @staticmethod
+    def submit(kind, items):
+        """Sends items for parsing, returns (future, batch) pairs to pass to results"""
+        jobs = []
+        for batch in ParserPool.__batches(items):
+            if ParserPool.max_workers:
+                try:
+                    jobs.append((ParserPool.executor().submit(parse_batch, kind, batch, ParserPool.backend), batch))
+                    continue
+                except BrokenProcessPool as e:
+                    logger.error(f"Parser processes are broken, parsing in place: {e}")
+                    ParserPool.shutdown()
+            future = Future()
+            future.set_result(parse_batch(kind, batch, ParserPool.backend))
+            jobs.append((future, batch))
+        return kind, jobs
+
+    @staticmethod
+    def results(submitted):
+        """Yields parsed candidates of submit in items order"""
+        kind, jobs = submitted
+        for future, batch in jobs:
+            try:
+                parsed = future.result()
+            except BrokenProcessPool as e:
+                logger.error(f"Parser processes are broken, parsing in place: {e}")
+                ParserPool.shutdown()
+                parsed = parse_batch(kind, batch, ParserPool.backend)
+            yield from (c for c in ParserPool.record(kind, parsed) if c)
+
+    @staticmethod
+    def parse(kind, items):
+        return list(ParserPool.results(ParserPool.submit(kind, items)))
+
+    @staticmethod
+    async def parse_async(kind, items):
+        if not ParserPool.max_workers:
+            return [c for c in ParserPool.record(kind, parse_batch(kind, items, ParserPool.backend)) if c]
+        loop = asyncio.get_running_loop()
+        batches = ParserPool.__batches(items)
+        results = await asyncio.gather(
+            *(loop.run_in_executor(ParserPool.executor(), parse_batch, kind, batch, ParserPool.backend) for batch in batches),
+            return_exceptions=True
+        )
+        candidates = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, BrokenProcessPool):
+                logger.error(f"Parser processes are broken, parsing in place: {result}")
+                ParserPool.shutdown()
+                result = parse_batch(kind, batch, ParserPool.backend)
+            elif isinstance(result, Exception):
+                logger.error(f"Failed to parse batch of candidates: {result}")
+                Metrics.failure("parse", type(result).__name__)
+                continue
+            candidates.extend(c for c in ParserPool.record(kind, result) if c)
+        return candidates
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of fetched pages
+
+    Every entry is one json file named by sha256 of namespace and url. Entries are fresh for the ttl of their
+    url class ("listing" or "resume"), stale entries keep ETag/Last-Modified for conditional revalidation.
+    File mtime is used as last access time, oldest files are evicted when the cache grows over max_bytes
+    """
+    ttls = {"listing": 60 * 60, "resume": 24 * 60 * 60}
+    url_classes = [
+        (re.compile(r"/resumes/\d+/?$"), "resume"),
+        (re.compile(r"/candidates/\d+"), "resume"),
+    ]
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, ttls=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(ResponseCache.ttls, **(ttls or {}))
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stores": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.size = None
+
+    def url_class(self, url, page_type=None):
+        if page_type:
+            return "resume" if page_type.endswith(("resume", "candidate")) else "listing"
+        path = urlsplit(url).path
+        for pattern, name in self.url_classes:
+            if pattern.search(path):
+                return name
+        return "listing"
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def __path(self, url, namespace):
+        digest = hashlib.sha256(f"{namespace}:{url}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".json")
+
+    def get(self, url, namespace="http"):
+        path = self.__path(url, namespace)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Broken cache entry {path}: {e}")
+            return None
+
+    def is_fresh(self, entry, url, page_type=None):
+        return time.time() - entry["stored_at"] < self.ttls[self.url_class(url, page_type)]
+
+    def lookup(self, url, page_type=None, namespace="http"):
+        """Returns cached body when there is a fresh entry, counts hit or miss"""
+        entry = self.get(url, namespace)
+        if entry and self.is_fresh(entry, url, page_type):
+            self.count("hits")
+            return entry["body"]
+        self.count("misses")
+        return None
+
+    @staticmethod
+    def revalidation_headers(entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["if-none-match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["if-modified-since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url, body, namespace="http", headers=None):
+        headers = headers or {}
+        entry = {
+            "url": url,
+            "stored_at": time.time(),
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "body": body
+        }
+        self.__write(self.__path(url, namespace), entry)
+        self.count("stores")
+
+    def refresh(self, url, entry, namespace="http"):
+        """Marks entry as fresh again after 304 Not Modified"""
+        entry["stored_at"] = time.time()
+        self.__write(self.__path(url, namespace), entry)
+        self.count("revalidated")
+
+    def __write(self, path, entry):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            new_size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Failed to write cache entry {path}: {e}")
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.__disk_size()
+            else:
+                self.size += new_size - old_size
+            over_limit = self.size > self.max_bytes
+        if over_limit:
+            self.__evict()
+
+    def __entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def __disk_size(self):
+        return sum(size for _, size, _ in self.__entries())
+
+    def __evict(self):
+        """Removes least recently used entries until the cache takes at most 90% of max_bytes"""
+        with self.lock:
+            entries = sorted(self.__entries(), key=lambda e: e[2])
+            self.size = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for path, size, _ in entries:
+                if self.size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.size -= size
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in list(self.__entries()):
+                os.remove(path)
+            self.size = 0
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import math
+import threading
+from datetime import datetime
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from pymongo.errors import PyMongoError
+from database_manager import AsyncDataBaseManager
+
+logger = logging.getLogger(__name__)
+
+
+class ParseScheduler:
+    """Queue of parse jobs stored in the parse_jobs collection
+
+    At most global_limit jobs run at once and at most per_user_limit of them belong to one user. Free slots
+    are given round-robin: the user who started a job least recently goes first, oldest job of that user first.
+    Jobs left running by a crashed bot are queued again on start. While MongoDB is unavailable the scheduler
+    logs the error and tries again every retry_delay seconds
+    """
+    global_limit = 3
+    per_user_limit = 1
+    default_duration = 5 * 60
+    retry_delay = 5
+
+    def __init__(self, bot, storage, runner, done_keyboard=None, global_limit=None, per_user_limit=None):
+        self.bot = bot
+        self.storage = storage
+        self.runner = runner
+        self.done_keyboard = done_keyboard
+        self.global_limit = global_limit or ParseScheduler.global_limit
+        self.per_user_limit = per_user_limit or ParseScheduler.per_user_limit
+        self.running = {}
+        # the event loop keeps only weak references to tasks, a job task is held here until it ends
+        self.tasks = set()
+        self.last_started = {}
+        self.wakeup = asyncio.Event()
+
+    @staticmethod
+    def jobs_db():
+        return AsyncDataBaseManager(collection_name="parse_jobs")
+
+    async def submit(self, user_id, chat_id, work_ua_query, rabota_ua_query):
+        job = {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "work_ua_query": work_ua_query,
+            "rabota_ua_query": rabota_ua_query,
+            "status": "queued",
+            "created_at": datetime.now()
+        }
+        async with self.jobs_db() as db:
+            job["_id"] = (await db.collection.insert_one(job)).inserted_id
+        self.wakeup.set()
+        return job
+
+    async def user_job(self, user_id):
+        async with self.jobs_db() as db:
+            return await db.collection.find_one(
+                {"user_id": user_id, "status": {"$in": ["queued", "running"]}}, sort=[("_id", 1)]
+            )
+
+    async def position(self, job):
+        """Place of the job in queue (0 when running) and estimated seconds until it ends"""
+        async with self.jobs_db() as db:
+            if job["status"] == "running":
+                position = 0
+            else:
+                position = await db.collection.count_documents({"status": "queued", "_id": {"$lte": job["_id"]}})
+            finished = await db.collection.find(
+                {"status": "done", "started_at": {"$exists": True}}, {"started_at": 1, "finished_at": 1}
+            ).sort("finished_at", -1).limit(20).to_list(length=20)
+
+        durations = [(j["finished_at"] - j["started_at"]).total_seconds() for j in finished]
+        average = sum(durations) / len(durations) if durations else ParseScheduler.default_duration
+        return position, average * (math.ceil(position / self.global_limit) + 1)
+
+    async def cancel(self, user_id):
+        """Cancels queued and running jobs of the user, returns amount of cancelled jobs"""
+        async with self.jobs_db() as db:
+            cancelled = (await db.collection.update_many(
+                {"user_id": user_id, "status": "queued"},
+                {"$set": {"status": "cancelled", "finished_at": datetime.now()}}
+            )).modified_count
+        for job_id, (job, cancel_event) in self.running.items():
+            if job["user_id"] == user_id:
+                cancel_event.set()
+                cancelled += 1
+        return cancelled
+
+    async def run(self):
+        while not await self.__requeue_interrupted():
+            await asyncio.sleep(ParseScheduler.retry_delay)
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.dispatch()
+            except PyMongoError as e:
+                logger.error(f"Failed to dispatch parse jobs, retrying in {ParseScheduler.retry_delay} s: {e}")
+                await asyncio.sleep(ParseScheduler.retry_delay)
+                continue
+            await self.wakeup.wait()
+
+    async def __requeue_interrupted(self):
+        try:
+            async with self.jobs_db() as db:
+                requeued = (await db.collection.update_many(
+                    {"status": "running"}, {"$set": {"status": "queued"}}
+                )).modified_count
+        except PyMongoError as e:
+            logger.error(f"Failed to requeue interrupted parse jobs, retrying in {ParseScheduler.retry_delay} s: {e}")
+            return False
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted parse jobs")
+        return True
+
+    async def dispatch(self):
+        if len(self.running) >= self.global_limit:
+            return
+        async with self.jobs_db() as db:
+            queued = await db.collection.find({"status": "queued"}).sort("_id", 1).to_list(length=None)
+            while queued and len(self.running) < self.global_limit:
+                job = self.__pick_next(queued)
+                if not job:
+                    break
+                queued.remove(job)
+                claimed = await db.collection.update_one(
+                    {"_id": job["_id"], "status": "queued"},
+                    {"$set": {"status": "running", "started_at": datetime.now()}}
+                )
+                if not claimed.modified_count:
+                    continue
+                job["status"] = "running"
+                job["started_at"] = datetime.now()
+                self.__start(job)
+
+    def __pick_next(self, queued):
+        running_per_user = {}
+        for job, _ in self.running.values():
+            running_per_user[job["user_id"]] = running_per_user.get(job["user_id"], 0) + 1
+
+        candidates = [j for j in queued if running_per_user.get(j["user_id"], 0) < self.per_user_limit]
+        if not candidates:
+            return None
+        # queued is sorted by _id (creation order) so min keeps the oldest job among users served equally long ago
+        return min(candidates, key=lambda j: self.last_started.get(j["user_id"], 0))
+
+    def __start(self, job):
+        cancel_event = threading.Event()
+        self.running[job["_id"]] = (job, cancel_event)
+        self.last_started[job["user_id"]] = datetime.now().timestamp()
+        logger.info(f"Starting parse job {job['_id']} of user {job['user_id']}")
+        task = asyncio.create_task(self.__execute(job, cancel_event))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __execute(self, job, cancel_event):
+        status = "done"
+        try:
+            report = await self.runner(job, cancel_event)
+            if cancel_event.is_set():
+                status = "cancelled"
+                report = "Parsing cancelled\n" + report
+        except Exception as e:
+            logger.error(f"Parse job {job['_id']} failed: {e}")
+            status = "failed"
+            report = "Parsing failed"
+        finally:
+            self.running.pop(job["_id"], None)
+            self.wakeup.set()
+
+        # the user is released whatever happens below, otherwise their chat stays blocked by the finished job
+        try:
+            async with self.jobs_db() as db:
+                await db.collection.update_one(
+                    {"_id": job["_id"]},
+                    {"$set": {"status": status, "finished_at": datetime.now(), "report": report}}
+                )
+        except Exception as e:
+            logger.error(f"Failed to store status {status} of parse job {job['_id']}: {e}")
+        finally:
+            await self.release_user(job["user_id"], job["chat_id"])
+        try:
+            await self.bot.send_message(job["chat_id"], report, reply_markup=self.done_keyboard)
+        except Exception as e:
+            logger.error(f"Failed to send report of parse job {job['_id']}: {e}")
+
+    async def release_user(self, user_id, chat_id):
+        state = FSMContext(storage=self.storage, key=StorageKey(bot_id=self.bot.id, chat_id=chat_id, user_id=user_id))
+        await state.clear()
@@ -0,0 +1,16 @@
+"""Every golden page parsed by every html backend matches its expected json, see check_backends.py"""
+import json
+
+import pytest
+
+from check_backends import expected_path, golden_pages, normalize, read_page, run_backend
+from parsers import HTML_BACKENDS
+
+
+@pytest.mark.parametrize("backend_name", sorted(HTML_BACKENDS))
+@pytest.mark.parametrize("name, method", golden_pages())
+def test_backend_matches_golden(name, method, backend_name):
+    page_text, link = read_page(name)
+    with open(expected_path(name), encoding="utf-8") as f:
+        expected = json.load(f)
+    assert normalize(run_backend(HTML_BACKENDS[backend_name], method, page_text, link)) == expected
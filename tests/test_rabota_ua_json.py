@@ -0,0 +1,42 @@
+"""RabotaUa.parse_candidate_json against the resume payloads of the mock board, see benchmarks/mock_board.py"""
+import pytest
+
+from benchmarks.mock_board import BoardConfig, rabota_ua_candidate, rabota_ua_candidate_json
+from database_manager import MarksManager
+from parsers import RabotaUa
+
+CANDIDATE_IDS = range(20000000, 20000040)
+# candidate keys MarksManager.count_mark_rabotaua reads
+SCORED_KEYS = ("education", "job_experience", "skills", "languages")
+
+
+@pytest.mark.parametrize("candidate_id", CANDIDATE_IDS)
+def test_json_has_scored_keys(candidate_id):
+    candidate = RabotaUa.parse_candidate_json([rabota_ua_candidate_json(BoardConfig(), candidate_id)])
+    for key in SCORED_KEYS:
+        assert key in candidate
+
+
+@pytest.mark.parametrize("candidate_id", CANDIDATE_IDS)
+def test_json_matches_dom(candidate_id):
+    config = BoardConfig()
+    link = f"http://127.0.0.1/rabota_ua/candidates/{candidate_id}"
+    from_json = RabotaUa.parse_candidate_json([rabota_ua_candidate_json(config, candidate_id)])
+    from_dom = RabotaUa.parse_candidate_page(rabota_ua_candidate(config, candidate_id), link)
+    for key in ("job_experience", "education", "languages", "name", "employment"):
+        assert from_json[key] == from_dom.get(key)
+    assert from_json["skills"]["skills"] == from_dom["skills"]["skills"]
+    with MarksManager() as m:
+        assert m.count_mark_rabotaua(from_json) == m.count_mark_rabotaua(from_dom)
+
+
+@pytest.mark.parametrize("payloads", [
+    [],
+    [{"data": [1, "a", None]}, "text", 5],
+    [{"fullName": 1, "experiences": {"position": "x"}, "skills": {"name": "x"}, "languages": 3}],
+    [{"fullName": None, "firstName": "Олена", "skills": [{"title": None}, 3, {"name": "Python"}],
+      "languages": "Англійська\nУкраїнська", "educations": [None, {"name": ["x"]}]}],
+])
+def test_unexpected_json_shapes(payloads):
+    candidate = RabotaUa.parse_candidate_json(payloads)
+    assert candidate == {} or all(key in candidate for key in SCORED_KEYS)